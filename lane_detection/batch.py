@@ -0,0 +1,217 @@
+import glob
+import os
+import numpy as np
+import cv2
+from utils import find_lane_pixels_using_windows, measure_lanes
+from fitting import fit_from_moments, has_fit_rows
+from perspective import load_camera_parameters, scale_camera_matrix, get_remap_tables, remap
+from thresholds import DEFAULT_PROFILE
+
+
+### Batched Lane Detection on Stacks of Still Images ###
+
+# Approximate bytes of working memory per pixel of a frame in a batch
+# (raw, undistorted and converted frames, gray, int16 Sobel, masks, binary and warped binary)
+BYTES_PER_PIXEL = 20
+
+
+def batch_size_for(frame_shape, memory_budget):
+    # Number of frames of the given shape whose working memory fits in the budget (at least 1)
+    return max(1, int(memory_budget // (frame_shape[0]*frame_shape[1]*BYTES_PER_PIXEL)))
+
+
+# File types read from a directory, compared case-insensitively
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+
+
+def image_paths(images):
+    # Sorted image files of a directory (every IMAGE_EXTENSIONS type) or of a glob pattern
+    if os.path.isdir(images):
+        return sorted(path for path in glob.glob(os.path.join(images, '*'))
+                      if os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS)
+    return sorted(glob.glob(images))
+
+
+def _read_images(images):
+    # A directory, a glob pattern or an iterable of paths / arrays, read lazily
+    # Files that can't be read or decoded are yielded as None
+    if isinstance(images, str):
+        images = image_paths(images)
+    for image in images:
+        yield cv2.imread(image) if isinstance(image, str) else image
+
+
+def iter_batches(images, memory_budget=512*2**20, unreadable=None):
+    """
+    Groups images into (N,H,W,3) stacks whose size follows the memory budget.
+
+    Images that can't be read are skipped, so one corrupt file does not abort a large run.
+
+    Parameters:
+        images: (N,H,W,3) array, directory, glob pattern, or iterable of image paths or arrays
+        memory_budget: Working memory allowed for one batch in bytes
+        unreadable: Optional list receiving the input index of every skipped image
+
+    Yields:
+        batch: (N,H,W,3) uint8 array, a new batch is started when the frame size changes
+    """
+    if isinstance(images, np.ndarray) and images.ndim == 4:
+        size = batch_size_for(images.shape[1:3], memory_budget)
+        for start in range(0, len(images), size):
+            yield images[start:start+size]
+        return
+    batch = []
+    for index, img in enumerate(_read_images(images)):
+        if img is None:
+            if unreadable is not None:
+                unreadable.append(index)
+            continue
+        if batch and (img.shape != batch[0].shape or len(batch) >= batch_size_for(batch[0].shape, memory_budget)):
+            yield np.stack(batch)
+            batch = []
+        batch.append(img)
+    if batch:
+        yield np.stack(batch)
+
+
+def batch_binary_thresholded(batch, valid_mask=None, sobel_gain=None, profile=None):
+    """
+    Same combined threshold as BinaryThresholder, computed over a whole (N,H,W,3) stack at once.
+
+    The stack is processed as a single (N*H,W) image by the lookup tables of the profile.
+    Every image gets its own reflected border rows for the Sobel and its own Sobel scaling maximum,
+    so each binary image is identical to the one of BinaryThresholder with the same profile.
+
+    Parameters:
+        batch: (N,H,W,3) BGR stack
+        valid_mask: Optional (H,W) 0/255 mask of the pixels to keep, e.g. RemapTables.fused_valid
+        sobel_gain: Optional (H,) per-row factor of the gradient, as in BinaryThresholder
+        profile: ThresholdProfile with the rules (default: the rules of binary_thresholded())
+
+    Returns:
+        binary: (N,H,W) uint8 array of 0/1
+    """
+    profile = profile or DEFAULT_PROFILE
+    n, height, width = batch.shape[:3]
+    flat = np.ascontiguousarray(batch).reshape(n*height, width, 3)
+    gray = cv2.cvtColor(flat, cv2.COLOR_BGR2GRAY)
+
+    # Colour rules through the lookup tables of the profile, the gray image is shared with the gradient
+    binary = profile.color_mask(flat, {'gray': gray}).reshape(n, height, width)
+    if profile.sobel_ranges:
+        sobel, max_sobel = _batch_sobel(gray.reshape(n, height, width), valid_mask, sobel_gain)
+        for low, high in profile.sobel_ranges:
+            binary |= _sobel_range_mask(sobel, max_sobel, low, high, exact=sobel_gain is None)
+
+    binary &= 1
+    if valid_mask is not None:
+        binary &= (valid_mask & 1)
+    return binary
+
+
+def _batch_sobel(gray, valid_mask=None, sobel_gain=None):
+    # |Sobel x| of every image of a (N,H,W) stack and its per-image maximum
+    n, height, width = gray.shape
+    # Pad every image with its own reflected rows (BORDER_REFLECT_101, the cv2.Sobel default)
+    padded = np.empty((n, height+2, width), np.uint8)
+    padded[:, 1:-1] = gray
+    padded[:, 0] = padded[:, 2]
+    padded[:, -1] = padded[:, -3]
+    sobel = cv2.Sobel(padded.reshape(n*(height+2), width), cv2.CV_16S, 1, 0)
+    sobel = np.abs(sobel.reshape(n, height+2, width)[:, 1:-1])
+    if sobel_gain is None:
+        return sobel, sobel.reshape(n, -1).max(axis=1).astype(np.int32)
+    # Gradient scaled back to frame pixels, its maximum is taken over the valid pixels only
+    sobel = sobel * sobel_gain.astype(np.float32)[None, :, None]
+    valid = sobel if valid_mask is None else sobel * (valid_mask > 0)
+    return sobel, valid.reshape(n, -1).max(axis=1)
+
+
+def _sobel_range_mask(sobel, max_sobel, low, high, exact):
+    # 0/1 mask of low <= uint8(255*|sobel|/max) <= high, with one pair of thresholds per image as in BinaryThresholder
+    if exact:
+        lower = (low*max_sobel + 254) // 255
+        upper = ((high+1)*max_sobel + 254) // 255 - 1
+    else:
+        lower = low*max_sobel/255
+        upper = np.nextafter(np.float32((high+1)*max_sobel/255), np.float32(0))
+    mask = sobel >= lower[:, None, None]
+    if high < 255:
+        mask &= sobel <= upper[:, None, None]
+    # A flat image scales to 0 everywhere
+    flat = max_sobel == 0
+    mask[flat] = low <= 0 <= high
+    return mask.view(np.uint8)
+
+
+def batch_histogram_bases(binary_warped):
+    # Peaks of the bottom-half histograms of the left and right halves, for every image of a (N,H,W) stack
+    height, width = binary_warped.shape[1:3]
+    histogram = binary_warped[:, height//2:, :].sum(axis=1, dtype=np.int32)
+    midpoint = int(width // 2)
+    leftx_base = np.argmax(histogram[:, :midpoint], axis=1)
+    rightx_base = np.argmax(histogram[:, midpoint:], axis=1) + midpoint
+    return leftx_base, rightx_base
+
+
+def detect_lanes_batch(images, memory_budget=512*2**20, warp_first=False, threshold_profile=None):
+    """
+    Finds the lane lines of many independent still images.
+
+    Parameters:
+        images: (N,H,W,3) array, directory, glob pattern, or iterable of image paths or arrays
+        memory_budget: Working memory allowed for one batch in bytes
+        warp_first: Threshold the warped colour frames instead of warping the thresholded frames
+        threshold_profile: ThresholdProfile of the camera (default: the rules of binary_thresholded())
+
+    Returns:
+        results: LaneResult of every image, in input order, None for the images that can't be read
+                 (see LaneResult.valid for the images where no lane was found)
+    """
+    mtx, dist = load_camera_parameters()
+    results = []
+    unreadable = []
+    for batch in iter_batches(images, memory_budget, unreadable):
+        n, height, width = batch.shape[:3]
+        tables = get_remap_tables(scale_camera_matrix(mtx, (width, height)), dist, (width, height))
+        if warp_first:
+            warped = np.empty_like(batch)
+            for i in range(n):
+                remap(batch[i], tables.fused, warped[i])
+            binary_warped = batch_binary_thresholded(warped, tables.fused_valid, tables.x_magnification,
+                                                     threshold_profile)
+        else:
+            undistorted = np.empty_like(batch)
+            for i in range(n):
+                remap(batch[i], tables.undistort, undistorted[i])
+            binary = batch_binary_thresholded(undistorted, profile=threshold_profile)
+            binary_warped = np.empty_like(binary)
+            for i in range(n):
+                remap(binary[i], tables.warp, binary_warped[i])
+
+        leftx_base, rightx_base = batch_histogram_bases(binary_warped)
+        for i in range(n):
+            leftx, lefty, rightx, righty = find_lane_pixels_using_windows(binary_warped[i], leftx_base=leftx_base[i],
+                                                                          rightx_base=rightx_base[i])
+            # An image where a line has pixels on fewer than 3 rows gets an invalid result with NaN fits
+            valid = has_fit_rows(lefty) and has_fit_rows(righty)
+            left_fit = fit_from_moments(leftx, lefty, height) if valid else np.full(3, np.nan)
+            right_fit = fit_from_moments(rightx, righty, height) if valid else np.full(3, np.nan)
+            results.append(measure_lanes(binary_warped[i], left_fit, right_fit, valid))
+    # The skipped images get their place back in the input order
+    for index in unreadable:
+        results.insert(index, None)
+    return results
+
+
+if __name__ == '__main__':
+    paths = image_paths('samples')
+    for path, lane in zip(paths, detect_lanes_batch(paths)):
+        if lane is None:
+            print('{:<28} unreadable, skipped'.format(path))
+            continue
+        if not lane.valid:
+            print('{:<28} no lane found'.format(path))
+            continue
+        print('{:<28} offset {:6.2f} m  angle {:6.2f} deg  radius {:9.1f} m'.format(
+            path, lane.veh_pos, lane.angle_difference, (lane.left_curverad + lane.right_curverad) / 2))
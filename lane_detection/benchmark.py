@@ -0,0 +1,328 @@
+import argparse
+import glob
+import json
+import platform
+import time
+import numpy as np
+import cv2
+from utils import (binary_thresholded, LanePipeline, prepare_frame, find_lane_pixels_using_histogram,
+                   find_lane_pixels_using_windows, process_image, lane_finding_pipeline)
+from thresholds import BinaryThresholder, ThresholdProfile
+from lane_pixels import LanePixels
+from tracking import LaneTracker
+from perspective import SRC_POINTS_NORMALIZED, load_camera_parameters, get_remap_tables, remap, perspective_transforms, WARP_OFFSET_NORMALIZED
+from profiling import PROFILER
+
+# Format version of the results file written by run_suite()
+RESULTS_VERSION = 2
+
+RESOLUTIONS = {'720p': (1280, 720), '1080p': (1920, 1080), '4k': (3840, 2160)}
+# Standard deviation of the gaussian noise added to the synthetic frames, in grey levels
+NOISE_LEVELS = (0, 15, 40)
+
+
+def load_samples(pattern='samples/*.jpg'):
+    return [cv2.imread(path) for path in sorted(glob.glob(pattern))]
+
+
+def time_call(fn, images, repeat=10):
+    # Mean time per image in milliseconds, the first pass warms up caches and buffers
+    for img in images:
+        fn(img)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for img in images:
+            fn(img)
+    return 1000 * (time.perf_counter() - start) / (repeat * len(images))
+
+
+def bench_thresholds(images, repeat=10):
+    """
+    Compares the combined-mask throughput of binary_thresholded() and BinaryThresholder.
+
+    Returns:
+        results: Mean milliseconds per frame for each variant
+    """
+    return {
+        'binary_thresholded': time_call(binary_thresholded, images, repeat),
+        'BinaryThresholder': time_call(BinaryThresholder(), images, repeat),
+        'BinaryThresholder_roi': time_call(BinaryThresholder(roi=SRC_POINTS_NORMALIZED), images, repeat),
+        'BinaryThresholder_bgr': time_call(BinaryThresholder(profile=ThresholdProfile(bgr_table=True)), images, repeat),
+    }
+
+
+def warped_binaries(images, noise=0.0, seed=0):
+    # Bird's-eye binary images of the samples, with a fraction of random pixels set to emulate noisy frames
+    rng = np.random.default_rng(seed)
+    mtx, dist = load_camera_parameters()
+    thresholder = BinaryThresholder()
+    binaries = []
+    for img in images:
+        tables = get_remap_tables(mtx, dist, (img.shape[1], img.shape[0]))
+        binary_warped = remap(thresholder(remap(img, tables.undistort)), tables.warp)
+        if noise > 0:
+            binary_warped = binary_warped | (rng.random(binary_warped.shape) < noise).astype(np.uint8)
+        binaries.append(binary_warped)
+    return binaries
+
+
+def bench_sliding_window(images, noise_levels=(0.0, 0.3), repeat=10):
+    """
+    Compares find_lane_pixels_using_histogram() and find_lane_pixels_using_windows() on clean and noisy frames.
+
+    The window search is timed on the binary image and on LanePixels extracted beforehand, as in the pipeline.
+    Both searches find the same pixels, which is checked by test_sliding_window.py.
+
+    Returns:
+        results: Mean milliseconds per frame for each variant and noise level
+    """
+    results = {}
+    for noise in noise_levels:
+        binaries = warped_binaries(images, noise)
+        set_pixels = int(np.mean([np.count_nonzero(b) for b in binaries]))
+        results['histogram_search noise={} ({} px)'.format(noise, set_pixels)] = time_call(find_lane_pixels_using_histogram, binaries, repeat)
+        results['window_search noise={} ({} px)'.format(noise, set_pixels)] = time_call(find_lane_pixels_using_windows, binaries, repeat)
+        results['lane_pixels noise={} ({} px)'.format(noise, set_pixels)] = time_call(LanePixels.from_binary, binaries, repeat)
+        pixel_sets = [LanePixels.from_binary(b) for b in binaries]
+        results['window_search_sparse noise={} ({} px)'.format(noise, set_pixels)] = time_call(find_lane_pixels_using_windows, pixel_sets, repeat)
+    return results
+
+
+def lane_fits(img, warp_first):
+    # Single frame fits of a fresh pipeline with the given ordering mode
+    pipeline = LanePipeline(warp_first=warp_first)
+    binary_warped = prepare_frame(img, pipeline.thresholder, warp_first)[2]
+    geometry = pipeline.find_lane_fits(binary_warped)
+    return geometry.left_fit, geometry.right_fit
+
+
+def ordering_deviation(paths, rows=(719, 360)):
+    """
+    Compares the fits of the threshold-then-warp and the warp-then-threshold orderings.
+
+    The deviations are only reported, the tolerance is checked by test_ordering.py.
+
+    Returns:
+        deviations: For each image path, the largest x difference in pixels of the left and right
+                    lanes at the given bird's-eye rows
+    """
+    deviations = {}
+    for path in paths:
+        img = cv2.imread(path)
+        reference = lane_fits(img, warp_first=False)
+        warped_first = lane_fits(img, warp_first=True)
+        deviations[path] = tuple(np.abs(np.polyval(a, rows) - np.polyval(b, rows)).max()
+                                 for a, b in zip(reference, warped_first))
+    return deviations
+
+
+def synthetic_lane_lines(img_size, i, n_frames, ploty):
+    # Bird's-eye x of the left and right lines of frame i of a synthetic drive at the rows ploty
+    width, height = img_size
+    offset = WARP_OFFSET_NORMALIZED*width
+    # Horizontal shift of the lines at the top of the image, the bottom stays in place
+    shift = 0.1*width*np.sin(2*np.pi*i/max(n_frames, 1))
+    curve = shift*((height - ploty) / height)**2
+    return offset + curve, width - offset + curve
+
+
+def synthetic_lane_frames(img_size, n_frames=20, noise=0, seed=0):
+    """
+    Generates a synthetic drive: a solid yellow left line and a dashed white right line on asphalt.
+
+    The lines are drawn in bird's-eye view with a curvature changing from frame to frame, and then
+    projected to the camera view with the inverse perspective transform of the frame size.
+
+    Yields:
+        frame: BGR frame of the given (width, height)
+    """
+    rng = np.random.default_rng(seed)
+    width, height = img_size
+    M_inv = perspective_transforms(img_size)[1]
+    ploty = np.arange(height)
+    thickness = max(2, width // 64)
+    dash = height // 6
+    for i in range(n_frames):
+        birdseye = np.full((height, width, 3), 90, np.uint8)
+        left_x, right_x = synthetic_lane_lines(img_size, i, n_frames, ploty)
+        left = np.int32(np.transpose(np.vstack([left_x, ploty])))
+        right = np.int32(np.transpose(np.vstack([right_x, ploty])))
+        cv2.polylines(birdseye, [left], False, (0, 200, 255), thickness)
+        # Dashes move down the image as the car drives forward
+        phase = (i*dash // 3) % (2*dash)
+        for start in range(-2*dash + phase, height, 2*dash):
+            segment = right[max(start, 0):max(min(start + dash, height), 0)]
+            if len(segment) > 1:
+                cv2.polylines(birdseye, [segment], False, (255, 255, 255), thickness)
+        # The surroundings of the road get the asphalt colour too, so that they add no edges
+        frame = cv2.warpPerspective(birdseye, M_inv, img_size, borderValue=(90, 90, 90))
+        if noise:
+            frame = np.clip(frame + rng.normal(0, noise, frame.shape), 0, 255).astype(np.uint8)
+        yield frame
+
+
+def _process_image_path(frame, pipeline):
+    process_image(frame, pipeline)
+
+
+def _lane_finding_path(frame, pipeline):
+    undistorted_img, _, binary_warped, M_inv = prepare_frame(frame, pipeline.thresholder)
+    lane_finding_pipeline(undistorted_img, binary_warped, pipeline, M_inv)
+
+
+# Frame paths timed by bench_frames(), each with its own LanePipeline and profiler run
+FRAME_PATHS = {'process_image': _process_image_path, 'lane_finding_pipeline': _lane_finding_path}
+
+
+def bench_frames(frames, path='process_image', warmup=2):
+    """
+    Runs one frame path of FRAME_PATHS on a sequence of frames with the profiler on.
+
+    Returns:
+        result: Number of frames, frames/s of the path and the per-stage profiler report
+    """
+    process = FRAME_PATHS[path]
+    pipeline = LanePipeline()
+    PROFILER.reset()
+    elapsed = 0.0
+    count = 0
+    for i, frame in enumerate(frames):
+        # The first frames build the remap tables and buffers and are not measured
+        if i == warmup:
+            PROFILER.enable()
+        start = time.perf_counter()
+        process(frame, pipeline)
+        if i >= warmup:
+            elapsed += time.perf_counter() - start
+            count += 1
+    PROFILER.disable()
+    return {'frames': count, 'fps': count / elapsed if elapsed else 0.0, 'stages': PROFILER.report()}
+
+
+def bench_tracking(img_size=RESOLUTIONS['720p'], n_frames=20, noise=0, seed=0, tracker=None):
+    """
+    Compares a LanePipeline with and without a LaneTracker on the same binary frames of a synthetic drive.
+
+    Returns:
+        result: Milliseconds per frame of find_lane_fits() and mean and largest error in pixels of the fits
+                from the drawn lines (at the top, middle and bottom rows) for both, and the number of frames
+                per kind of search of the tracker
+    """
+    tracker = tracker or LaneTracker(skip_alternate=True)
+    pipelines = {'untracked': LanePipeline(), 'tracked': LanePipeline(tracker=tracker)}
+    elapsed = {name: 0.0 for name in pipelines}
+    errors = {name: [] for name in pipelines}
+    rows = np.array([0, img_size[1]//2, img_size[1]-1])
+    frames = synthetic_lane_frames(img_size, n_frames, noise, seed)
+    for i, frame in enumerate(frames):
+        binary_warped = prepare_frame(frame, pipelines['untracked'].thresholder)[2]
+        left_x, right_x = synthetic_lane_lines(img_size, i, n_frames, rows)
+        for name, pipeline in pipelines.items():
+            start = time.perf_counter()
+            geometry = pipeline.find_lane_fits(binary_warped)
+            elapsed[name] += time.perf_counter() - start
+            errors[name].append(max(np.abs(np.polyval(geometry.left_fit, rows) - left_x).max(),
+                                    np.abs(np.polyval(geometry.right_fit, rows) - right_x).max()))
+    result = {'searches': dict(tracker.counts)}
+    for name in pipelines:
+        result[name] = {'ms': 1000*elapsed[name] / n_frames, 'mean_error_px': float(np.mean(errors[name])),
+                        'max_error_px': float(np.max(errors[name]))}
+    return result
+
+
+def run_suite(resolutions=tuple(RESOLUTIONS), noise_levels=NOISE_LEVELS, n_frames=20, seed=0, samples='samples/*.jpg'):
+    """
+    Benchmarks every stage on the bundled samples and on synthetic videos.
+
+    Returns:
+        results: Machine readable results, with the environment needed to judge reproducibility
+    """
+    results = {
+        'version': RESULTS_VERSION,
+        'created': time.time(),
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'cv2_threads': cv2.getNumThreads(),
+        },
+        'parameters': {'resolutions': list(resolutions), 'noise_levels': list(noise_levels), 'frames': n_frames, 'seed': seed},
+        'datasets': {},
+    }
+    images = load_samples(samples)
+    for path in FRAME_PATHS:
+        if images:
+            # The stills are repeated so the temporal search also runs on them
+            results['datasets']['samples/' + path] = bench_frames(images*2, path)
+        for name in resolutions:
+            for noise in noise_levels:
+                # The synthetic frames are generated again for every path, they only depend on the seed
+                frames = synthetic_lane_frames(RESOLUTIONS[name], n_frames, noise, seed)
+                results['datasets']['synthetic_{}_noise{}/{}'.format(name, noise, path)] = bench_frames(frames, path)
+    return results
+
+
+def compare(previous, current, tolerance=0.1):
+    """
+    Compares two results of run_suite().
+
+    Returns:
+        regressions: (dataset, stage, previous p50 ms, current p50 ms) of the stages more than tolerance slower
+    """
+    if previous.get('version') != current['version']:
+        raise ValueError('Cannot compare results of version {} with version {}'.format(previous.get('version'), current['version']))
+    regressions = []
+    for dataset, result in current['datasets'].items():
+        old = previous['datasets'].get(dataset)
+        if old is None:
+            continue
+        for stage, summary in result['stages'].items():
+            old_summary = old['stages'].get(stage)
+            if old_summary and summary['p50_ms'] > (1 + tolerance)*old_summary['p50_ms']:
+                regressions.append((dataset, stage, old_summary['p50_ms'], summary['p50_ms']))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the lane detection pipeline')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', help='Previous results file to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Allowed relative slowdown of a stage p50')
+    parser.add_argument('--resolutions', nargs='+', default=list(RESOLUTIONS), choices=list(RESOLUTIONS))
+    parser.add_argument('--noise', nargs='+', type=int, default=list(NOISE_LEVELS))
+    parser.add_argument('--frames', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--threads', type=int, help='Number of OpenCV threads, fixed for reproducible runs')
+    parser.add_argument('--micro', action='store_true', help='Also run the threshold and search micro-benchmarks')
+    args = parser.parse_args()
+    if args.threads is not None:
+        cv2.setNumThreads(args.threads)
+
+    if args.micro:
+        images = load_samples()
+        for name, ms in bench_thresholds(images).items():
+            print('{:<24} {:8.3f} ms/frame {:8.1f} frames/s'.format(name, ms, 1000 / ms))
+        for name, ms in bench_sliding_window(images).items():
+            print('{:<44} {:8.3f} ms/frame'.format(name, ms))
+        for path, (left_dev, right_dev) in ordering_deviation(sorted(glob.glob('samples/*.jpg'))).items():
+            print('{:<28} warp-first fit deviation left {:6.1f} px right {:6.1f} px'.format(path, left_dev, right_dev))
+        for noise in args.noise:
+            tracking = bench_tracking(RESOLUTIONS['720p'], args.frames, noise, args.seed)
+            for name in ('untracked', 'tracked'):
+                print('{:<9} noise={:<3} search+fit {:6.2f} ms/frame, error mean {:6.1f} px max {:6.1f} px'.format(
+                    name, noise, tracking[name]['ms'], tracking[name]['mean_error_px'], tracking[name]['max_error_px']))
+            print('tracker searches {}'.format(tracking['searches']))
+
+    results = run_suite(args.resolutions, args.noise, args.frames, args.seed)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    for dataset, result in results['datasets'].items():
+        print('{:<50} {:8.1f} frames/s'.format(dataset, result['fps']))
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), results, args.tolerance)
+        for dataset, stage, old_ms, new_ms in regressions:
+            print('SLOWER {:<50} {:<36} {:8.3f} ms -> {:8.3f} ms'.format(dataset, stage, old_ms, new_ms))
+        print('{} stage(s) slower than {:.0%} tolerance'.format(len(regressions), args.tolerance))
@@ -0,0 +1,142 @@
+import hashlib
+import multiprocessing
+import os
+import time
+import numpy as np
+import cv2
+
+
+### Camera Calibration with Cached Corner Detection ###
+
+# Format version of the calibration artifact written by save_calibration()
+CALIBRATION_VERSION = 1
+
+# Sub-pixel refinement of the detected corners
+SUBPIX_WINDOW = (11, 11)
+SUBPIX_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+
+
+def file_hash(path):
+    # Content hash of an image, identical images share their cached corners whatever their name
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def detect_corners(path, nx=9, ny=6):
+    """
+    Finds and refines the chessboard corners of one calibration image.
+
+    Returns:
+        corners: (nx*ny, 1, 2) float32 corners, None if the image can't be read or the board is not found
+        shape: (height, width) of the image, None if it can't be read
+    """
+    img = cv2.imread(path)
+    if img is None:
+        return None, None
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    ret, corners = cv2.findChessboardCorners(gray, (nx, ny), None)
+    if not ret:
+        return None, gray.shape
+    corners = cv2.cornerSubPix(gray, corners, SUBPIX_WINDOW, (-1, -1), SUBPIX_CRITERIA)
+    return corners, gray.shape
+
+
+def _detect_corners_args(args):
+    return detect_corners(*args)
+
+
+def load_corner_cache(cache_path):
+    # Dict of content hash -> (corners or None, image shape or None)
+    cache = {}
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as data:
+            for key in data.files:
+                if key.endswith('_shape'):
+                    continue
+                corners = data[key]
+                shape = tuple(int(v) for v in data[key + '_shape']) or None
+                cache[key] = (corners if corners.size else None, shape)
+    return cache
+
+
+def save_corner_cache(cache_path, cache):
+    arrays = {}
+    for key, (corners, shape) in cache.items():
+        arrays[key] = np.float32([]) if corners is None else corners
+        arrays[key + '_shape'] = np.int32(shape or [])
+    np.savez(cache_path, **arrays)
+
+
+def find_all_corners(image_dir, nx=9, ny=6, processes=None, cache_path=None):
+    """
+    Detects the chessboard corners of every image of a directory, in parallel and with a cache.
+
+    The corners are cached per image content hash, so only new or modified images are processed again.
+
+    Returns:
+        detections: List of (image name, corners or None, image shape or None), sorted by name
+    """
+    if cache_path is None:
+        cache_path = os.path.join(image_dir, 'corners_cache_{}x{}.npz'.format(nx, ny))
+    cache = load_corner_cache(cache_path)
+    names = sorted(name for name in os.listdir(image_dir)
+                   if os.path.isfile(os.path.join(image_dir, name)) and not name.endswith('.npz'))
+    hashes = [file_hash(os.path.join(image_dir, name)) for name in names]
+
+    missing = sorted(set(h for h in hashes if h not in cache))
+    if missing:
+        paths = {h: os.path.join(image_dir, name) for name, h in zip(names, hashes)}
+        args = [(paths[h], nx, ny) for h in missing]
+        if processes == 1 or len(args) == 1:
+            found = list(map(_detect_corners_args, args))
+        else:
+            with multiprocessing.Pool(processes) as pool:
+                found = pool.map(_detect_corners_args, args)
+        cache.update(zip(missing, found))
+        save_corner_cache(cache_path, cache)
+    return [(name,) + cache[h] for name, h in zip(names, hashes)]
+
+
+def calibrate(image_dir='camera_calibration_images/', nx=9, ny=6, processes=None, cache_path=None):
+    """
+    Calibrates the camera from the chessboard images of a directory.
+
+    Images that can't be read or where the board is not found are skipped. The image size is the most
+    common size of the images the board was found on, images of another size are skipped.
+
+    Returns:
+        mtx, dist: Camera matrix and distortion coefficients
+        rms: Reprojection error in pixels
+        used: Names of the images used for the calibration
+        image_size: (width, height) of the calibration images
+    """
+    detections = find_all_corners(image_dir, nx, ny, processes, cache_path)
+    detections = [d for d in detections if d[1] is not None]
+    if not detections:
+        raise ValueError('No chessboard found in ' + image_dir)
+    shapes = [shape for _, _, shape in detections]
+    height, width = max(set(shapes), key=shapes.count)
+    detections = [d for d in detections if d[2] == (height, width)]
+
+    # Object points are real world points, z coordinates are 0 and x, y are equidistant chessboard squares
+    objp = np.zeros((nx*ny, 3), np.float32)
+    objp[:, :2] = np.mgrid[0:nx, 0:ny].T.reshape(-1, 2)
+    objpoints = [objp]*len(detections)
+    imgpoints = [corners for _, corners, _ in detections]
+    rms, mtx, dist, rvecs, tvecs = cv2.calibrateCamera(objpoints, imgpoints, (width, height), None, None)
+    return mtx, dist, rms, [name for name, _, _ in detections], (width, height)
+
+
+def save_calibration(path, mtx, dist, rms, used, image_size):
+    # Single versioned artifact with everything needed to reproduce and judge the calibration
+    np.savez(path, version=CALIBRATION_VERSION, created=time.time(), camera_matrix=mtx,
+             distortion_coefficients=dist, reprojection_error=rms, images=np.array(used),
+             image_size=np.int32(image_size))
+
+
+def load_calibration(path):
+    # Returns the camera matrix and distortion coefficients of an artifact written by save_calibration()
+    with np.load(path) as data:
+        if int(data['version']) > CALIBRATION_VERSION:
+            raise ValueError('Unsupported calibration version {} in {}'.format(int(data['version']), path))
+        return data['camera_matrix'], data['distortion_coefficients']
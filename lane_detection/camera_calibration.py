@@ -1,6 +1,8 @@
-from utils import distortion_factors
+from calibration import calibrate, save_calibration
 import numpy as np
 
-mtx, dist = distortion_factors()
+mtx, dist, rms, used, image_size = calibrate('camera_calibration_images/')
+print('Calibrated from {} images, reprojection error {:.3f} px'.format(len(used), rms))
+save_calibration('camera_calibration.npz', mtx, dist, rms, used, image_size)
 np.save('camera_matrix.npy', mtx)
 np.save('distortion_coefficients.npy', dist)
\ No newline at end of file
@@ -0,0 +1,8 @@
+import os
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def lane_detection_dir(monkeypatch):
+    # The camera files and the samples are read relative to this directory, wherever pytest is started from
+    monkeypatch.chdir(os.path.dirname(os.path.abspath(__file__)))
@@ -0,0 +1,120 @@
+import numpy as np
+
+
+### Least-Squares Lane Fitting from Moment Sums ###
+
+# Define conversions in x and y from pixels space to meters
+YM_PER_PIX = 30/720 # meters per pixel in y dimension
+XM_PER_PIX = 3.7/700 # meters per pixel in x dimension
+# Bird's-eye image size the conversions above were measured at
+REFERENCE_SIZE = (1280, 720)
+# Distinct pixel rows needed by a second order fit x = f(y)
+MIN_FIT_ROWS = 3
+
+
+def meters_per_pixel(shape):
+    # The bird's-eye view always spans the same road area, so the conversions follow its (height, width)
+    ym_per_pix = YM_PER_PIX * (REFERENCE_SIZE[1] / shape[0])
+    xm_per_pix = XM_PER_PIX * (REFERENCE_SIZE[0] / shape[1])
+    return ym_per_pix, xm_per_pix
+
+
+def scale_fit(fit, x_scale, y_scale):
+    # Converts a fit made on an image scaled by (x_scale, y_scale) back to the unscaled image coordinates
+    return np.array([fit[0]*y_scale**2/x_scale, fit[1]*y_scale/x_scale, fit[2]/x_scale])
+
+
+def has_fit_rows(y):
+    # True if the pixel rows y determine a second order fit, the normal equations are singular otherwise
+    y = np.asarray(y)
+    return bool(len(y) >= MIN_FIT_ROWS and np.count_nonzero(np.bincount(y.astype(np.intp))) >= MIN_FIT_ROWS)
+
+
+def moment_sums(x, y, y_scale=1.0):
+    """
+    Returns the sums needed by the normal equations of a second order fit x = f(y).
+
+    y is divided by y_scale (e.g. the image height) to keep the powers of y well conditioned.
+
+    Returns:
+        y_sums: [sum(1), sum(y), sum(y^2), sum(y^3), sum(y^4)]
+        xy_sums: [sum(x), sum(x*y), sum(x*y^2)]
+    """
+    y = np.asarray(y, dtype=np.float64) / y_scale
+    x = np.asarray(x, dtype=np.float64)
+    y2 = y*y
+    y_sums = np.array([len(y), y.sum(), y2.sum(), (y2*y).sum(), (y2*y2).sum()])
+    xy_sums = np.array([x.sum(), x.dot(y), x.dot(y2)])
+    return y_sums, xy_sums
+
+
+def solve_normal_equations(y_sums, xy_sums, y_scale=1.0):
+    """
+    Solves the 3x3 normal equations built from moment sums.
+
+    Returns:
+        fit: Coefficients [a, b, c] of x = a*y^2 + b*y + c in pixel units, like np.polyfit(y, x, 2),
+             NaN if the sums come from fewer than 3 distinct rows
+    """
+    A = np.array([
+        [y_sums[4], y_sums[3], y_sums[2]],
+        [y_sums[3], y_sums[2], y_sums[1]],
+        [y_sums[2], y_sums[1], y_sums[0]]
+    ])
+    rhs = xy_sums[::-1]
+    try:
+        fit = np.linalg.solve(A, rhs)
+    except np.linalg.LinAlgError:
+        # Fewer than 3 distinct rows, no fit exists and a made-up one would look like a lane at x = 0
+        return np.full(3, np.nan)
+    # Undo the scaling of y
+    return fit / np.array([y_scale**2, y_scale, 1.0])
+
+
+def fit_from_moments(x, y, y_scale=1.0):
+    # Single frame least-squares fit, same result as np.polyfit(y, x, 2), NaN if y has fewer than 3 distinct rows
+    if not has_fit_rows(y):
+        return np.full(3, np.nan)
+    return solve_normal_equations(*moment_sums(x, y, y_scale), y_scale)
+
+
+class MomentFitter:
+    """
+    Second order lane fit over moment sums accumulated across frames.
+
+    Parameters:
+        decay: Weight kept by the sums of the previous frames on every update,
+               0 fits the current frame only, values towards 1 smooth the fit over time
+        y_scale: Scale applied to y before the sums are computed (e.g. the image height)
+    """
+    def __init__(self, decay=0.0, y_scale=720.0):
+        self.decay = decay
+        self.y_scale = y_scale
+        self.reset()
+
+    def reset(self):
+        self.y_sums = np.zeros(5)
+        self.xy_sums = np.zeros(3)
+
+    def update(self, x, y, weight=1.0):
+        # Decay the sums of the previous frames and add the weighted sums of the new pixels
+        y_sums, xy_sums = moment_sums(x, y, self.y_scale)
+        self.y_sums = self.decay*self.y_sums + weight*y_sums
+        self.xy_sums = self.decay*self.xy_sums + weight*xy_sums
+        return self.fit()
+
+    def fit(self):
+        return solve_normal_equations(self.y_sums, self.xy_sums, self.y_scale)
+
+
+def fit_to_meters(fit, ym_per_pix=YM_PER_PIX, xm_per_pix=XM_PER_PIX):
+    # x_m = xm*x_px and y_m = ym*y_px, so the meter coefficients follow directly from the pixel ones
+    return np.array([fit[0]*xm_per_pix/ym_per_pix**2, fit[1]*xm_per_pix/ym_per_pix, fit[2]*xm_per_pix])
+
+
+def curvature_radius_meters(fit, y_eval, ym_per_pix=YM_PER_PIX, xm_per_pix=XM_PER_PIX):
+    """
+    Returns the radius of curvature in meters of a pixel space fit at the pixel row y_eval.
+    """
+    fit_cr = fit_to_meters(fit, ym_per_pix, xm_per_pix)
+    return ((1 + (2*fit_cr[0]*y_eval*ym_per_pix + fit_cr[1])**2)**1.5) / np.absolute(2*fit_cr[0])
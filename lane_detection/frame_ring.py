@@ -0,0 +1,58 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+
+### Shared-Memory Frame Ring ###
+
+class FrameRing:
+    """
+    Fixed number of frame slots in one shared memory block, visible to every process attached to it.
+
+    Each slot holds one array per field, e.g. the decoded frame and the warped binary image. Processes
+    exchange slot indices, the frames themselves are never pickled.
+
+    Parameters:
+        slots: Number of slots
+        fields: Dict of field name -> (shape, dtype) of the array stored per slot
+        name: Name of an existing block to attach to, a new block is created when None
+    """
+    def __init__(self, slots, fields, name=None):
+        self.slots = slots
+        self.fields = {key: (tuple(shape), np.dtype(dtype).str) for key, (shape, dtype) in fields.items()}
+        # Byte offset of every field inside a slot
+        self.offsets = {}
+        self.slot_size = 0
+        for key, (shape, dtype) in self.fields.items():
+            self.offsets[key] = self.slot_size
+            self.slot_size += int(np.prod(shape)) * np.dtype(dtype).itemsize
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=max(slots*self.slot_size, 1))
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.views = [{key: self._view(slot, key) for key in self.fields} for slot in range(slots)]
+
+    def _view(self, slot, key):
+        shape, dtype = self.fields[key]
+        offset = slot*self.slot_size + self.offsets[key]
+        return np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset)
+
+    @property
+    def spec(self):
+        # Everything another process needs to attach to the ring, small enough to send as a message
+        return self.slots, self.fields, self.shm.name
+
+    @classmethod
+    def attach(cls, spec):
+        slots, fields, name = spec
+        return cls(slots, fields, name)
+
+    def view(self, slot, key):
+        return self.views[slot][key]
+
+    def close(self):
+        # The views must be released before the shared memory can be closed
+        self.views = []
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
@@ -3,25 +3,25 @@ from moviepy.editor import VideoFileClip
 from utils import *
 
 
-left_fit_hist = np.array([])
-right_fit_hist = np.array([])
+# Lane finding state of the stream, one pipeline per camera or video
+pipeline = LanePipeline()
 
 """
 video_output = 'samples/project_video_output.mp4'
 clip1 = VideoFileClip("samples/project_video.mp4")
-output_clip = clip1.fl_image(lambda frame: process_image(frame, left_fit_hist, right_fit_hist))
+output_clip = clip1.fl_image(lambda frame: process_image(frame, pipeline))
 output_clip.write_videofile(video_output, audio=False)
 """
 """
 
 test_image = cv2.imread('samples/test5.jpg')
-processed_image = lane_finding_pipeline(test_image, left_fit_hist, right_fit_hist)
+processed_image = lane_finding_pipeline(test_image, binary_warped, pipeline, M_inv)
 cv2.imwrite('samples/test_image_output.jpg', processed_image)
 """
 #"""
 
 test_image = cv2.imread('samples/test5.jpg')
-processed_image = process_image(test_image, left_fit_hist, right_fit_hist)
-#print(diffrence_angle)
-cv2.imwrite('samples/test_image5.jpg', processed_image)
+result = detect_lanes(test_image, pipeline, overlays=OVERLAYS)
+print('Angle difference:', result.lane.angle_difference)
+cv2.imwrite('samples/test_image5.jpg', result.image)
 #"""
\ No newline at end of file
@@ -0,0 +1,69 @@
+import numpy as np
+import cv2
+from profiling import profile_stage
+
+
+### Sparse Lane Pixels of a Warped Binary Image ###
+
+# Largest image dimension the int16 coordinates can address
+MAX_DIMENSION = np.iinfo(np.int16).max + 1
+
+
+class LanePixels:
+    """
+    Nonzero pixels of a warped binary image, extracted once per frame and shared by the search, fit and angle stages.
+
+    The pixels are stored in row-major order as int16 coordinates. row_offsets[y] is the index of the first
+    pixel of row y, so the pixels of rows [y0, y1) are the slice row_offsets[y0]:row_offsets[y1].
+
+    Attributes:
+        x, y: int16 column and row of every nonzero pixel
+        row_offsets: (height+1,) index of the first pixel of every row
+        shape: (height, width) of the binary image, like binary_warped.shape
+    """
+    def __init__(self, x, y, row_offsets, shape):
+        self.x = x
+        self.y = y
+        self.row_offsets = row_offsets
+        self.shape = tuple(shape[:2])
+
+    @classmethod
+    @profile_stage('lane_pixels')
+    def from_binary(cls, binary_warped):
+        # A single scan of the dense image, cv2.findNonZero returns the pixels in row-major order
+        height, width = binary_warped.shape[:2]
+        if height > MAX_DIMENSION or width > MAX_DIMENSION:
+            raise ValueError('Binary image of shape {} is too large for int16 coordinates'.format(binary_warped.shape))
+        points = cv2.findNonZero(binary_warped)
+        if points is None:
+            xy = np.zeros((0, 2), np.int16)
+        else:
+            xy = points.reshape(-1, 2).astype(np.int16)
+        x, y = np.ascontiguousarray(xy[:, 0]), np.ascontiguousarray(xy[:, 1])
+        # The rows are sorted, a binary search per row gives the start of every row
+        row_offsets = np.searchsorted(y, np.arange(height + 1, dtype=np.int32))
+        return cls(x, y, row_offsets, (height, width))
+
+    def __len__(self):
+        return len(self.x)
+
+    def rows(self, low, high):
+        # Slice of the pixels in the rows [low, high)
+        return slice(self.row_offsets[max(low, 0)], self.row_offsets[min(high, self.shape[0])])
+
+    def histogram(self, low=0):
+        # Column histogram of the rows below low, same as np.sum(binary_warped[low:,:], axis=0) for a 0/1 image
+        return np.bincount(self.x[self.row_offsets[low]:], minlength=self.shape[1])
+
+    def to_binary(self):
+        # Dense 0/1 image of the pixels
+        binary = np.zeros(self.shape, np.uint8)
+        binary[self.y, self.x] = 1
+        return binary
+
+
+def as_lane_pixels(binary_warped):
+    # Stages accept either a warped binary image or the LanePixels already extracted from it
+    if isinstance(binary_warped, LanePixels):
+        return binary_warped
+    return LanePixels.from_binary(binary_warped)
@@ -0,0 +1,63 @@
+import numpy as np
+import cv2
+from profiling import profile_stage
+
+
+### Lane Overlay Projected in Image Space ###
+
+class LaneOverlay:
+    """
+    Draws the lane area found in bird's-eye view onto the camera image.
+
+    Only the polygon vertices are projected with M_inv, the polygon is then filled directly in image space,
+    and the blend is limited to its bounding box, in place in the image. No full-frame warp or blend is made.
+    The colour buffer is reused across frames and only reallocated when the frame size changes.
+
+    Parameters:
+        color: BGR colour of the lane area
+        alpha: Weight of the lane colour added to the image
+    """
+    def __init__(self, color=(0, 255, 0), alpha=0.3):
+        self.color = color
+        self.alpha = alpha
+        self.buffer = None
+
+    def lane_polygon(self, ploty, left_fitx, right_fitx, M_inv, warped_width):
+        # Left line from top to bottom, then right line from bottom to top, kept inside the bird's-eye image
+        # as the fill in bird's-eye view was, and projected to the camera image
+        left = np.column_stack([np.clip(left_fitx, 0, warped_width-1), ploty])
+        right = np.column_stack([np.clip(right_fitx, 0, warped_width-1), ploty])[::-1]
+        pts = np.vstack([left, right]).reshape(-1, 1, 2)
+        return cv2.perspectiveTransform(pts, M_inv).reshape(-1, 2)
+
+    @profile_stage('lane_overlay')
+    def __call__(self, img, ploty, left_fitx, right_fitx, M_inv, warped_width):
+        """
+        Blends the lane area into img in place.
+
+        Parameters:
+            img: BGR image the lane is drawn on
+            ploty, left_fitx, right_fitx: Lane lines in bird's-eye pixels
+            M_inv: Inverse perspective transformation matrix, from bird's-eye to image pixels
+            warped_width: Width of the bird's-eye image
+
+        Returns:
+            img: The same image with the lane area blended
+        """
+        if self.buffer is None or self.buffer.shape != img.shape:
+            self.buffer = np.empty_like(img)
+        polygon = np.int32(np.round(self.lane_polygon(ploty, left_fitx, right_fitx, M_inv, warped_width)))
+
+        # Bounding box of the projected polygon, clipped to the image
+        height, width = img.shape[:2]
+        x0, y0 = np.maximum(polygon.min(axis=0), 0)
+        x1, y1 = np.minimum(polygon.max(axis=0) + 1, (width, height))
+        if x0 >= x1 or y0 >= y1:
+            return img
+        box = (slice(y0, y1), slice(x0, x1))
+        color_box = self.buffer[box]
+        color_box.fill(0)
+        cv2.fillPoly(color_box, [polygon - (x0, y0)], self.color)
+        img_box = img[box]
+        cv2.addWeighted(img_box, 1, color_box, self.alpha, 0, dst=img_box)
+        return img
@@ -0,0 +1,175 @@
+import numpy as np
+import cv2
+
+
+### Undistortion and Perspective Remap Tables ###
+
+# Frame size the source points, the warp offset and the camera calibration were measured at
+REFERENCE_SIZE = (1280, 720)
+# Source points taken from images with straight lane lines, these are to become parallel after the warp transform
+SRC_POINTS = np.float32([
+    (190, 720), # bottom-left corner
+    (596, 447), # top-left corner
+    (685, 447), # top-right corner
+    (1125, 720) # bottom-right corner
+])
+# Horizontal offset of the destination lines from the image borders
+WARP_OFFSET = 300
+# Same quad and offset as fractions of the frame size, used for every other resolution
+SRC_POINTS_NORMALIZED = SRC_POINTS / np.float32(REFERENCE_SIZE)
+WARP_OFFSET_NORMALIZED = WARP_OFFSET / REFERENCE_SIZE[0]
+
+# Caches shared by every frame of the same camera and frame size
+_camera_cache = {}
+_transform_cache = {}
+_remap_cache = {}
+
+
+def load_camera_parameters(matrix_path='camera_matrix.npy', dist_path='distortion_coefficients.npy'):
+    # The calibration files never change during a run, so they are read from disk only once
+    key = (matrix_path, dist_path)
+    if key not in _camera_cache:
+        _camera_cache[key] = (np.load(matrix_path), np.load(dist_path))
+    return _camera_cache[key]
+
+
+def scale_camera_matrix(mtx, img_size, calibration_size=REFERENCE_SIZE):
+    # Focal lengths and principal point follow the frame size, the distortion coefficients are unchanged
+    if tuple(img_size) == tuple(calibration_size):
+        return mtx
+    scale = np.array([[img_size[0]/calibration_size[0]], [img_size[1]/calibration_size[1]], [1.0]])
+    return mtx * scale
+
+
+def source_points(img_size):
+    # Warp source quad for a frame size
+    return SRC_POINTS_NORMALIZED * np.float32(img_size)
+
+
+def destination_points(img_size, offset=None):
+    # Destination points are to be parallel, taken into account the image size
+    if offset is None:
+        offset = WARP_OFFSET_NORMALIZED * img_size[0]
+    return np.float32([
+        [offset, img_size[1]],             # bottom-left corner
+        [offset, 0],                       # top-left corner
+        [img_size[0]-offset, 0],           # top-right corner
+        [img_size[0]-offset, img_size[1]]  # bottom-right corner
+    ])
+
+
+def _cache_key(img_size, *arrays):
+    return (tuple(img_size),) + tuple(np.ascontiguousarray(a, dtype=np.float64).tobytes() for a in arrays)
+
+
+def perspective_transforms(img_size, src=None, dst=None):
+    """
+    Returns the perspective transformation matrix and its inverse for a frame size.
+
+    Parameters:
+        img_size: (width, height) of the frame
+        src, dst: Source and destination quads (default: source_points(img_size) and destination_points(img_size))
+
+    Returns:
+        M, M_inv: Matrices computed once per quad and frame size
+    """
+    if src is None:
+        src = source_points(img_size)
+    if dst is None:
+        dst = destination_points(img_size)
+    key = _cache_key(img_size, src, dst)
+    if key not in _transform_cache:
+        M = cv2.getPerspectiveTransform(np.float32(src), np.float32(dst))
+        M_inv = cv2.getPerspectiveTransform(np.float32(dst), np.float32(src))
+        _transform_cache[key] = (M, M_inv)
+    return _transform_cache[key]
+
+
+def _pixel_grid(img_size):
+    # Coordinates of every output pixel as an (N, 1, 2) array, the layout expected by cv2 point functions
+    xs, ys = np.meshgrid(np.arange(img_size[0], dtype=np.float32), np.arange(img_size[1], dtype=np.float32))
+    return np.dstack((xs, ys)).reshape(-1, 1, 2)
+
+
+def _distort_points(points, mtx, dist):
+    # Map pixels of the undistorted image (new camera matrix = mtx) to pixels of the raw camera image
+    homogeneous = np.dstack((points, np.ones(points.shape[:2], dtype=np.float32))).reshape(-1, 3)
+    normalized = homogeneous.astype(np.float64) @ np.linalg.inv(mtx).T
+    distorted, _ = cv2.projectPoints(normalized, np.zeros(3), np.zeros(3), mtx, dist)
+    return distorted.astype(np.float32)
+
+
+def _fixed_point(map_xy, img_size):
+    # Fixed point maps are considerably faster to apply with cv2.remap than float maps
+    map_xy = map_xy.reshape(img_size[1], img_size[0], 2)
+    return cv2.convertMaps(map_xy, None, cv2.CV_16SC2)
+
+
+class RemapTables:
+    """
+    Lookup tables for one camera, warp quad and frame size.
+
+    The bird's-eye view can be produced at a smaller out_size than the frame, e.g. to threshold and
+    search a downscaled image, M and M_inv then map between the frame and that smaller bird's-eye view.
+
+    Attributes:
+        undistort: Maps raw frame -> undistorted frame (same as cv2.undistort)
+        warp: Maps undistorted frame -> bird's-eye view (same as warp())
+        fused: Maps raw frame -> bird's-eye view in a single cv2.remap
+        fused_valid: 0/255 mask of the bird's-eye pixels sampled inside the raw frame
+        M, M_inv: Perspective transformation matrix and its inverse
+        scale: (x, y) scale of the bird's-eye view relative to the frame size
+        x_magnification: Bird's-eye pixels per frame pixel along x, for every bird's-eye row
+    """
+    def __init__(self, mtx, dist, img_size, src=None, dst=None, out_size=None):
+        self.img_size = tuple(img_size)
+        self.out_size = tuple(out_size or img_size)
+        self.scale = (self.out_size[0]/self.img_size[0], self.out_size[1]/self.img_size[1])
+        M, M_inv = perspective_transforms(img_size, src, dst)
+        # Downscaling is applied after the perspective transform
+        S = np.diag([self.scale[0], self.scale[1], 1.0])
+        self.M = S @ M
+        self.M_inv = M_inv @ np.linalg.inv(S)
+
+        map_x, map_y = cv2.initUndistortRectifyMap(mtx, dist, None, mtx, self.img_size, cv2.CV_16SC2)
+        self.undistort = (map_x, map_y)
+
+        # cv2.warpPerspective samples the source at M_inv * (x, y) for every output pixel
+        grid = _pixel_grid(self.out_size)
+        warp_xy = cv2.perspectiveTransform(grid, self.M_inv)
+        self.warp = _fixed_point(warp_xy, self.out_size)
+        # The source quad has horizontal top and bottom edges, so a bird's-eye row is stretched uniformly along x
+        center = self.out_size[0] // 2
+        rows_xy = warp_xy.reshape(self.out_size[1], self.out_size[0], 2)
+        step = np.abs(rows_xy[:, min(center+1, self.out_size[0]-1), 0] - rows_xy[:, max(center-1, 0), 0])
+        self.x_magnification = np.float32(2 / np.maximum(step, 1e-6))
+        # Chaining the distortion model behind the inverse warp gives the raw frame pixel directly
+        self.fused = _fixed_point(_distort_points(warp_xy, mtx, dist), self.out_size)
+        # The black border outside the raw frame would otherwise produce strong gradients once warped
+        frame = np.full((self.img_size[1], self.img_size[0]), 255, np.uint8)
+        self.fused_valid = cv2.erode(remap(frame, self.fused), np.ones((3, 3), np.uint8), iterations=2)
+
+
+def get_remap_tables(mtx, dist, img_size, src=None, dst=None, out_size=None):
+    """
+    Returns the cached RemapTables for a camera, warp quad, frame size and bird's-eye size, building them on first use.
+    """
+    if src is None:
+        src = source_points(img_size)
+    if dst is None:
+        dst = destination_points(img_size)
+    out_size = tuple(out_size or img_size)
+    key = _cache_key(img_size, mtx, dist, src, dst) + (out_size,)
+    if key not in _remap_cache:
+        _remap_cache[key] = RemapTables(mtx, dist, img_size, src, dst, out_size)
+    return _remap_cache[key]
+
+
+def search_size(img_size, search_scale=1.0):
+    # Size of the bird's-eye view used for thresholding and lane search
+    return (max(1, int(round(img_size[0]*search_scale))), max(1, int(round(img_size[1]*search_scale))))
+
+
+def remap(img, maps, out=None):
+    # Apply a pair of fixed point maps, the output size is given by the maps
+    return cv2.remap(img, maps[0], maps[1], cv2.INTER_LINEAR, dst=out)
@@ -0,0 +1,156 @@
+import contextlib
+import functools
+import json
+import time
+import tracemalloc
+import numpy as np
+
+
+### Per-Stage Latency and Allocation Instrumentation ###
+
+class StageStats:
+    """
+    Wall-clock samples and allocation counters of one pipeline stage.
+
+    Only the last max_samples durations are kept for the percentiles, the count and total cover every call.
+    """
+    def __init__(self, max_samples=10000):
+        self.samples = np.zeros(max_samples)
+        self.count = 0
+        self.total = 0.0
+        self.alloc_count = 0
+        self.alloc_bytes = 0
+
+    def add(self, seconds, alloc_bytes=None):
+        self.samples[self.count % len(self.samples)] = seconds
+        self.count += 1
+        self.total += seconds
+        if alloc_bytes is not None:
+            self.alloc_count += 1
+            self.alloc_bytes += alloc_bytes
+
+    def summary(self):
+        samples = self.samples[:min(self.count, len(self.samples))]
+        p50, p95, p99 = np.percentile(samples, [50, 95, 99]) if self.count else (0.0, 0.0, 0.0)
+        return {
+            'count': self.count,
+            'total_s': self.total,
+            'p50_ms': 1000*p50,
+            'p95_ms': 1000*p95,
+            'p99_ms': 1000*p99,
+            # Peak bytes allocated while the stage ran, averaged over the calls that were traced
+            'alloc_bytes_per_call': self.alloc_bytes / self.alloc_count if self.alloc_count else 0.0,
+        }
+
+
+class Profiler:
+    """
+    Collects per-stage timings. Disabled by default, a disabled stage costs a single flag check.
+
+    Parameters:
+        max_samples: Number of durations kept per stage for the percentiles
+    """
+    def __init__(self, max_samples=10000):
+        self.enabled = False
+        self.track_allocations = False
+        self.max_samples = max_samples
+        self.stages = {}
+        # Allocation peaks of the stages currently running, innermost last
+        self._alloc_stack = []
+
+    def enable(self, track_allocations=False):
+        # Allocations are traced with tracemalloc, which slows down the pipeline noticeably
+        self.enabled = True
+        self.track_allocations = track_allocations
+        if track_allocations and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def disable(self):
+        self.enabled = False
+        if self.track_allocations and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.track_allocations = False
+
+    def reset(self):
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def _measure(self, name):
+        traced = self.track_allocations and tracemalloc.is_tracing()
+        if traced:
+            current, peak = tracemalloc.get_traced_memory()
+            # The peak is reset for this stage, the enclosing stage remembers the highest peak seen so far
+            if self._alloc_stack:
+                self._alloc_stack[-1][1] = max(self._alloc_stack[-1][1], peak)
+            tracemalloc.reset_peak()
+            self._alloc_stack.append([current, current])
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            alloc_bytes = None
+            if traced:
+                start_mem, peak_seen = self._alloc_stack.pop()
+                peak = max(tracemalloc.get_traced_memory()[1], peak_seen)
+                alloc_bytes = peak - start_mem
+                if self._alloc_stack:
+                    self._alloc_stack[-1][1] = max(self._alloc_stack[-1][1], peak)
+            if name not in self.stages:
+                self.stages[name] = StageStats(self.max_samples)
+            self.stages[name].add(elapsed, alloc_bytes)
+
+    def stage(self, name):
+        # Context manager timing a block of code as a stage
+        if not self.enabled:
+            return _NULL_CONTEXT
+        return self._measure(name)
+
+    def report(self):
+        return {name: stats.summary() for name, stats in sorted(self.stages.items())}
+
+    def export_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+    def export_prometheus(self, path, prefix='lane_pipeline'):
+        # Prometheus text exposition format, one summary per stage
+        lines = [
+            '# HELP {}_stage_seconds Wall-clock time of a pipeline stage'.format(prefix),
+            '# TYPE {}_stage_seconds summary'.format(prefix),
+        ]
+        for name, summary in self.report().items():
+            for quantile in ('50', '95', '99'):
+                lines.append('{}_stage_seconds{{stage="{}",quantile="0.{}"}} {:.9f}'.format(
+                    prefix, name, quantile, summary['p{}_ms'.format(quantile)] / 1000))
+            lines.append('{}_stage_seconds_sum{{stage="{}"}} {:.9f}'.format(prefix, name, summary['total_s']))
+            lines.append('{}_stage_seconds_count{{stage="{}"}} {}'.format(prefix, name, summary['count']))
+        lines.append('# HELP {}_stage_alloc_bytes Peak bytes allocated per call of a pipeline stage'.format(prefix))
+        lines.append('# TYPE {}_stage_alloc_bytes gauge'.format(prefix))
+        for name, summary in self.report().items():
+            lines.append('{}_stage_alloc_bytes{{stage="{}"}} {:.0f}'.format(prefix, name, summary['alloc_bytes_per_call']))
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+# Profiler shared by all the pipeline stages of the process
+PROFILER = Profiler()
+
+
+def profile_stage(name=None):
+    """
+    Decorator timing every call of a function as a stage (the function name by default).
+    """
+    def decorator(fn):
+        stage_name = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not PROFILER.enabled:
+                return fn(*args, **kwargs)
+            with PROFILER._measure(stage_name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,171 @@
+import asyncio
+import time
+from collections import namedtuple
+import cv2
+from utils import LanePipeline, detect_lanes
+
+
+### Streaming Lane Detection on Live Sources ###
+
+# Published for every processed frame, latency is measured from the capture of the frame
+StreamResult = namedtuple('StreamResult', ['frame_id', 'capture_time', 'latency', 'lane'])
+
+
+class CaptureSource:
+    """
+    Frame source backed by cv2.VideoCapture: a capture device index, a video file or a stream URL.
+    """
+    def __init__(self, source):
+        self.capture = cv2.VideoCapture(source)
+
+    def read(self):
+        # Blocks until the next frame is available, None at the end of the source
+        ret, frame = self.capture.read()
+        return frame if ret else None
+
+    def close(self):
+        self.capture.release()
+
+
+class ImageLoopSource:
+    """
+    Local stand-in for a camera: delivers a list of images at a fixed frame rate.
+
+    Parameters:
+        images: Frames to deliver, in order
+        fps: Frame rate of the emulated camera
+        loops: Number of times the list is delivered (None: forever)
+    """
+    def __init__(self, images, fps=25, loops=1):
+        self.images = images
+        self.period = 1.0 / fps
+        self.loops = loops
+        self.index = 0
+        self.next_time = None
+
+    def read(self):
+        if self.loops is not None and self.index >= self.loops*len(self.images):
+            return None
+        # Emulate the camera clock, frames are not delivered faster than the frame rate
+        now = time.perf_counter()
+        if self.next_time is None:
+            self.next_time = now
+        if self.next_time > now:
+            time.sleep(self.next_time - now)
+        self.next_time += self.period
+        frame = self.images[self.index % len(self.images)]
+        self.index += 1
+        return frame
+
+    def close(self):
+        pass
+
+
+def _offer(queue, item):
+    # Latest item wins: a full queue drops its oldest item, returns True if one was dropped
+    dropped = False
+    if queue.full():
+        queue.get_nowait()
+        dropped = True
+    queue.put_nowait(item)
+    return dropped
+
+
+class LaneStream:
+    """
+    Asyncio driven lane detection on a live frame source with bounded latency.
+
+    The source is read continuously in a thread. When processing falls behind, only the latest
+    frame is kept and older ones are dropped, so delay never accumulates. Results are published
+    to every subscriber queue, which also keeps only the latest results when a consumer is slow.
+
+    Parameters:
+        source: Object with blocking read() returning a BGR frame or None, and close()
+        pipeline: LanePipeline of the stream (a new one by default)
+        max_age: Optional maximum age in seconds of a frame when its processing starts, older frames are dropped
+    """
+    def __init__(self, source, pipeline=None, max_age=None):
+        self.source = source
+        self.pipeline = pipeline or LanePipeline()
+        self.max_age = max_age
+        self.subscribers = []
+        self.frames_read = 0
+        self.frames_processed = 0
+        self.frames_dropped = 0
+
+    def subscribe(self, maxsize=1):
+        # Queue of StreamResult, None is published when the stream ends, after the latest result was taken,
+        # so the subscriber has to read the queue until None
+        queue = asyncio.Queue(maxsize)
+        self.subscribers.append(queue)
+        return queue
+
+    def detect(self, frame):
+        return detect_lanes(frame, self.pipeline).lane
+
+    async def _read(self, mailbox):
+        loop = asyncio.get_running_loop()
+        while True:
+            frame = await loop.run_in_executor(None, self.source.read)
+            if frame is None:
+                break
+            self.frames_read += 1
+            self.frames_dropped += _offer(mailbox, (self.frames_read - 1, time.perf_counter(), frame))
+        # The end of the stream waits for the pending frame to be taken, so the last frame is still processed
+        await mailbox.put(None)
+
+    async def _process(self, mailbox):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await mailbox.get()
+            if item is None:
+                break
+            frame_id, capture_time, frame = item
+            if self.max_age is not None and time.perf_counter() - capture_time > self.max_age:
+                self.frames_dropped += 1
+                continue
+            lane = await loop.run_in_executor(None, self.detect, frame)
+            self.frames_processed += 1
+            result = StreamResult(frame_id, capture_time, time.perf_counter() - capture_time, lane)
+            for queue in self.subscribers:
+                _offer(queue, result)
+        # Likewise the end of the stream does not replace the latest result
+        for queue in self.subscribers:
+            await queue.put(None)
+
+    async def run(self):
+        """
+        Reads and processes the source until it ends.
+
+        Returns:
+            stats: Number of frames read, processed and dropped
+        """
+        mailbox = asyncio.Queue(1)
+        try:
+            await asyncio.gather(self._read(mailbox), self._process(mailbox))
+        finally:
+            self.source.close()
+        return {'read': self.frames_read, 'processed': self.frames_processed, 'dropped': self.frames_dropped}
+
+
+async def _print_results(queue):
+    while True:
+        result = await queue.get()
+        if result is None:
+            break
+        print('frame {:5d} latency {:6.1f} ms  offset {:6.2f} m  angle {:6.2f} deg'.format(
+            result.frame_id, 1000*result.latency, result.lane.veh_pos, result.lane.angle_difference))
+
+
+async def _main(source):
+    stream = LaneStream(source)
+    printer = asyncio.ensure_future(_print_results(stream.subscribe()))
+    stats = await stream.run()
+    await printer
+    print(stats)
+
+
+if __name__ == '__main__':
+    import glob
+    images = [cv2.imread(path) for path in sorted(glob.glob('samples/*.jpg'))]
+    asyncio.run(_main(ImageLoopSource(images, fps=60, loops=5)))
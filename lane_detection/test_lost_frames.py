@@ -0,0 +1,36 @@
+import numpy as np
+import cv2
+from utils import LanePipeline, detect_lanes, OVERLAYS
+from fitting import has_fit_rows, fit_from_moments
+from batch import detect_lanes_batch
+
+BLACK = np.zeros((720, 1280, 3), np.uint8)
+
+
+def test_fit_needs_three_distinct_rows():
+    x, y = np.array([10, 12, 11, 13]), np.array([5, 5, 9, 9])
+    assert not has_fit_rows(y)
+    assert np.isnan(fit_from_moments(x, y)).all()
+    assert has_fit_rows(np.array([5, 7, 9]))
+
+
+def test_empty_frame_is_lost_and_kept_out_of_the_history():
+    pipeline = LanePipeline()
+    result = detect_lanes(BLACK, pipeline, overlays=OVERLAYS)
+    assert not result.lane.valid
+    assert np.isnan(result.lane.veh_pos)
+    assert pipeline.hist_len == 0
+    assert result.image is not None
+
+    good = detect_lanes(cv2.imread('samples/test3.jpg'), pipeline)
+    assert good.lane.valid and pipeline.hist_len == 1
+    # With a history, a lost frame reports the fits the search was guided by
+    lost = detect_lanes(BLACK, pipeline)
+    assert not lost.lane.valid
+    assert pipeline.hist_len == 1
+    np.testing.assert_allclose(lost.lane.left_fit, good.lane.left_fit)
+
+
+def test_batch_flags_empty_images():
+    lanes = detect_lanes_batch(np.stack([BLACK, cv2.imread('samples/test3.jpg')]))
+    assert [lane.valid for lane in lanes] == [False, True]
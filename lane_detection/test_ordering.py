@@ -0,0 +1,64 @@
+import glob
+import os
+import numpy as np
+import cv2
+import pytest
+from utils import LanePipeline, prepare_frame, find_lane_pixels_using_windows
+from perspective import load_camera_parameters, get_remap_tables
+
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'samples')
+SAMPLES = sorted(os.path.basename(path) for path in glob.glob(os.path.join(SAMPLES_DIR, '*.jpg')))
+
+# The two orderings may place a line edge differently by:
+# - the reach of the 3x3 Sobel kernel, in frame pixels when thresholding before the warp
+EDGE_ERROR_FRAME_PX = 1
+# - the reach of the Sobel kernel in bird's-eye pixels when thresholding after the warp, plus one pixel
+#   of bilinear interpolation of the warp
+EDGE_ERROR_WARPED_PX = 2
+# Two lane lines and their edges cover about a tenth of the bird's-eye view, a mask with more than a quarter
+# of its pixels set is dominated by shadows or road texture and the search follows them in either ordering
+MAX_FILL = 0.25
+
+
+def ordering_fits(img, warp_first):
+    # Bird's-eye binary image, lane pixels and single frame fits of a fresh pipeline
+    pipeline = LanePipeline(warp_first=warp_first)
+    binary_warped = prepare_frame(img, pipeline.thresholder, warp_first)[2]
+    pixels = find_lane_pixels_using_windows(binary_warped)
+    geometry = pipeline.find_lane_fits(binary_warped)
+    return binary_warped, pixels, (geometry.left_fit, geometry.right_fit)
+
+
+def tolerance(img):
+    # Allowed x difference in bird's-eye pixels for every row, a frame pixel spans x_magnification bird's-eye pixels
+    mtx, dist = load_camera_parameters()
+    tables = get_remap_tables(mtx, dist, (img.shape[1], img.shape[0]))
+    return EDGE_ERROR_FRAME_PX*tables.x_magnification + EDGE_ERROR_WARPED_PX
+
+
+def usable(img):
+    binary_warped = ordering_fits(img, warp_first=False)[0]
+    return np.count_nonzero(binary_warped) <= MAX_FILL*binary_warped.size
+
+
+def test_enough_usable_samples():
+    # The fill cap must not leave the ordering test without inputs
+    assert sum(usable(cv2.imread(os.path.join(SAMPLES_DIR, name))) for name in SAMPLES) >= 5
+
+
+@pytest.mark.parametrize('name', SAMPLES)
+def test_warp_first_fits_within_edge_error(name):
+    img = cv2.imread(os.path.join(SAMPLES_DIR, name))
+    reference_binary, reference_pixels, reference_fits = ordering_fits(img, warp_first=False)
+    fill = np.count_nonzero(reference_binary) / reference_binary.size
+    if fill > MAX_FILL:
+        pytest.skip('{:.0%} of the bird\'s-eye pixels are set, the mask is flooded'.format(fill))
+    _, warped_pixels, warped_fits = ordering_fits(img, warp_first=True)
+
+    row_tolerance = tolerance(img)
+    for lane, (reference_fit, warped_fit) in enumerate(zip(reference_fits, warped_fits)):
+        # The fits are compared on the rows of the lane pixels of both orderings, weighted by the pixel count,
+        # the gaps of a dashed line only hold extrapolations of the fits
+        rows = np.concatenate([reference_pixels[2*lane+1], warped_pixels[2*lane+1]])
+        deviation = np.abs(np.polyval(reference_fit, rows) - np.polyval(warped_fit, rows)) / row_tolerance[rows]
+        assert np.sqrt(np.mean(deviation**2)) <= 1, '{} lane deviates beyond the edge error'.format(('left', 'right')[lane])
@@ -0,0 +1,50 @@
+import functools
+import glob
+import os
+import numpy as np
+import cv2
+import pytest
+from utils import prepare_frame, search_parameters, find_lane_pixels_using_histogram, find_lane_pixels_using_windows
+from thresholds import BinaryThresholder
+from lane_pixels import LanePixels
+
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'samples')
+
+# Frame sizes of the bird's-eye images, the search runs at the size of the frame
+SIZES = ((1280, 720), (960, 540), (854, 481), (1280, 600))
+# Fraction of random pixels set on top of the thresholded image, 0.3 is much noisier than a real frame
+NOISE_LEVELS = (0.0, 0.3)
+# (nwindows, margin, minpix), None: search_parameters() of the image
+SEARCHES = ((9, None, None), (12, 60, 20), (5, 150, 200), (7, 30, 0))
+
+
+@functools.lru_cache(maxsize=None)
+def warped_samples(size, noise):
+    # Bird's-eye binary images of the samples resized to the frame size, with random pixels set
+    rng = np.random.default_rng(0)
+    thresholder = BinaryThresholder()
+    binaries = []
+    for path in sorted(glob.glob(os.path.join(SAMPLES_DIR, '*.jpg'))):
+        binary_warped = prepare_frame(cv2.resize(cv2.imread(path), size), thresholder)[2].copy()
+        if noise > 0:
+            binary_warped |= (rng.random(binary_warped.shape) < noise).astype(np.uint8)
+        binaries.append(binary_warped)
+    return binaries
+
+
+@pytest.mark.parametrize('nwindows, margin, minpix', SEARCHES)
+@pytest.mark.parametrize('noise', NOISE_LEVELS)
+@pytest.mark.parametrize('size', SIZES)
+def test_windows_match_histogram_search(size, noise, nwindows, margin, minpix):
+    for binary_warped in warped_samples(size, noise):
+        assert binary_warped.shape == (size[1], size[0])
+        default_margin, default_minpix = search_parameters(binary_warped.shape)
+        search = {'nwindows': nwindows,
+                  'margin': default_margin if margin is None else margin,
+                  'minpix': default_minpix if minpix is None else minpix}
+        reference = find_lane_pixels_using_histogram(binary_warped, **search)
+        # The window search takes the binary image or the LanePixels extracted from it
+        for pixels in (binary_warped, LanePixels.from_binary(binary_warped)):
+            found = find_lane_pixels_using_windows(pixels, **search)
+            for name, expected, actual in zip(('leftx', 'lefty', 'rightx', 'righty'), reference, found):
+                assert np.array_equal(expected, actual), '{} differ'.format(name)
@@ -0,0 +1,37 @@
+import asyncio
+import time
+import numpy as np
+from streaming import LaneStream, ImageLoopSource
+
+
+class SlowLaneStream(LaneStream):
+    # Processing slower than the source, so frames are dropped
+    def detect(self, frame):
+        time.sleep(0.02)
+        return int(frame[0, 0, 0])
+
+
+async def _collect(stream):
+    queue = stream.subscribe()
+    results = []
+
+    async def consume():
+        while True:
+            result = await queue.get()
+            if result is None:
+                return
+            results.append(result)
+    consumer = asyncio.ensure_future(consume())
+    stats = await stream.run()
+    await consumer
+    return stats, results
+
+
+def test_latest_frame_wins_keeps_the_last_frame():
+    images = [np.full((4, 4, 3), i, np.uint8) for i in range(24)]
+    stats, results = asyncio.run(_collect(SlowLaneStream(ImageLoopSource(images, fps=200))))
+    assert stats['dropped'] > 0
+    assert stats['read'] == 24
+    assert stats['processed'] + stats['dropped'] == stats['read']
+    # The newest frame of the source is processed and its result reaches the subscriber
+    assert results[-1].frame_id == 23 and results[-1].lane == 23
@@ -0,0 +1,286 @@
+import json
+import numpy as np
+import cv2
+from profiling import profile_stage
+
+
+### Threshold Profiles Compiled to Lookup Tables ###
+
+# Colour spaces a rule can test, converted from the BGR frame (None: the frame itself)
+COLOR_SPACES = {
+    'gray': cv2.COLOR_BGR2GRAY,
+    'hls': cv2.COLOR_BGR2HLS,
+    'hsv': cv2.COLOR_BGR2HSV,
+    'lab': cv2.COLOR_BGR2LAB,
+    'bgr': None,
+}
+
+# Rules of binary_thresholded(): (space, channel, low, high) with inclusive bounds, a pixel is kept if any rule matches
+# 'sobel_x' is |Sobel x| of the gray image scaled to 0-255 by its maximum
+DEFAULT_RULES = (
+    ('sobel_x', 0, 30, 255),
+    ('gray', 0, 201, 255),
+    ('hls', 2, 91, 255),
+    ('hls', 0, 11, 25),
+)
+
+
+class ThresholdProfile:
+    """
+    Declarative threshold rules, compiled once into 256-entry lookup tables.
+
+    Every colour rule becomes a range of its channel's lookup table, so each channel used by the rules
+    costs a single cv2.LUT per frame whatever the number of rules. Optionally all the colour rules are
+    compiled into one 2^24-entry BGR -> mask table, which then replaces the colour conversions.
+
+    Parameters:
+        rules: Iterable of (space, channel, low, high), space is 'sobel_x' or one of COLOR_SPACES
+        name: Name of the profile (e.g. 'day', 'night')
+        bgr_table: Use the BGR -> mask table for the colour rules (16 MiB, built on first use)
+    """
+    def __init__(self, rules=DEFAULT_RULES, name='default', bgr_table=False):
+        self.rules = [(space, int(channel), int(low), int(high)) for space, channel, low, high in rules]
+        self.name = name
+        self.bgr_table = bgr_table
+        for space, channel, low, high in self.rules:
+            if space != 'sobel_x' and space not in COLOR_SPACES:
+                raise ValueError('Unknown colour space {!r} in threshold profile {!r}'.format(space, name))
+        self.sobel_ranges = [(low, high) for space, _, low, high in self.rules if space == 'sobel_x']
+        self.luts = self._compile_luts()
+        self._bgr_table = None
+
+    @classmethod
+    def from_dict(cls, config, name='default'):
+        # {'rules': [[space, channel, low, high], ...], 'bgr_table': false}
+        return cls(config['rules'], config.get('name', name), config.get('bgr_table', False))
+
+    def to_dict(self):
+        return {'name': self.name, 'rules': [list(rule) for rule in self.rules], 'bgr_table': self.bgr_table}
+
+    def _compile_luts(self):
+        # One 0/255 table per (space, channel) used by the rules, the ranges of a channel are merged into its table
+        luts = {}
+        for space, channel, low, high in self.rules:
+            if space == 'sobel_x':
+                continue
+            lut = luts.setdefault((space, channel), np.zeros(256, np.uint8))
+            lut[max(low, 0):min(high, 255)+1] = 255
+        return luts
+
+    def color_mask(self, img, buffers=None, out=None):
+        """
+        Applies the colour rules to a BGR image.
+
+        Parameters:
+            img: BGR image
+            buffers: Optional dict of reusable arrays, filled on first use ('gray', if present, must already hold
+                     the gray image of img)
+            out: Optional uint8 array receiving the mask
+
+        Returns:
+            mask: 0/255 mask of the pixels matching any colour rule
+        """
+        if buffers is None:
+            buffers = {}
+        height, width = img.shape[:2]
+        if out is None:
+            out = np.empty((height, width), np.uint8)
+        if self.bgr_table:
+            return self._table_mask(img, buffers, out)
+        if not self.luts:
+            out.fill(0)
+            return out
+        converted = {}
+        for i, ((space, channel), lut) in enumerate(self.luts.items()):
+            if space not in converted:
+                converted[space] = self._convert(img, space, buffers)
+            plane = converted[space]
+            if plane.ndim == 3:
+                plane = cv2.extractChannel(plane, channel, dst=_buffer(buffers, 'channel', (height, width)))
+            # The first table writes the mask, the next ones are added to it
+            if i == 0:
+                cv2.LUT(plane, lut, dst=out)
+            else:
+                cv2.LUT(plane, lut, dst=_buffer(buffers, 'lut', (height, width)))
+                cv2.bitwise_or(out, buffers['lut'], dst=out)
+        return out
+
+    def _convert(self, img, space, buffers):
+        height, width = img.shape[:2]
+        if space == 'gray':
+            gray = buffers.get('gray')
+            if gray is None or gray.shape != (height, width):
+                gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            return gray
+        if COLOR_SPACES[space] is None:
+            return img
+        return cv2.cvtColor(img, COLOR_SPACES[space], dst=_buffer(buffers, space, (height, width, 3)))
+
+    def table(self):
+        # Mask of every BGR colour, indexed by b | g << 8 | r << 16
+        if self._bgr_table is None:
+            colors = np.arange(2**24, dtype=np.uint32).view(np.uint8).reshape(4096, 4096, 4)[:, :, :3]
+            profile = ThresholdProfile(self.rules, self.name)
+            self._bgr_table = profile.color_mask(np.ascontiguousarray(colors)).reshape(-1)
+        return self._bgr_table
+
+    def _table_mask(self, img, buffers, out):
+        height, width = img.shape[:2]
+        # Alpha is 255, the little-endian 32-bit value of a BGRA pixel is then b | g << 8 | r << 16 | 255 << 24
+        bgra = cv2.cvtColor(img, cv2.COLOR_BGR2BGRA, dst=_buffer(buffers, 'bgra', (height, width, 4)))
+        index = _buffer(buffers, 'index', (height, width), np.uint32)
+        np.bitwise_and(bgra.view(np.uint32).reshape(height, width), 0xFFFFFF, out=index)
+        np.take(self.table(), index, out=out)
+        return out
+
+
+def _buffer(buffers, key, shape, dtype=np.uint8):
+    # Reusable array of a buffers dict, reallocated when the shape changes
+    array = buffers.get(key)
+    if array is None or array.shape != shape or array.dtype != dtype:
+        array = buffers[key] = np.empty(shape, dtype)
+    return array
+
+
+def load_threshold_profiles(path='threshold_profiles.json'):
+    """
+    Reads the threshold profiles of every camera from a JSON file.
+
+    The file maps a camera name to its profiles, e.g. {"front": {"day": {"rules": [...]}, "night": {...}}}.
+
+    Returns:
+        profiles: Dict of camera -> dict of profile name -> ThresholdProfile
+    """
+    with open(path) as f:
+        config = json.load(f)
+    return {camera: {name: ThresholdProfile.from_dict(profile, name) for name, profile in profiles.items()}
+            for camera, profiles in config.items()}
+
+
+# Default profile of BinaryThresholder, its rules reproduce the fixed chain of binary_thresholded()
+DEFAULT_PROFILE = ThresholdProfile(DEFAULT_RULES, 'day')
+
+
+### Fused Color and Gradient Threshold ###
+
+class BinaryThresholder:
+    """
+    Same combined threshold as binary_thresholded(), computed into buffers reused across frames.
+
+    The gradient is kept in int16 and every mask in uint8, no float64 image is created.
+    The returned binary image is one of the internal buffers and is overwritten on the next call.
+
+    Parameters:
+        roi: Optional polygon in fractions of the frame width and height (e.g. SRC_POINTS_NORMALIZED, the warp
+             source quad), scaled to the size of every frame. Only its bounding box is thresholded and the rest
+             of the output stays 0. The Sobel scaling then uses the maximum inside the ROI.
+        roi_margin: Pixels added around the ROI bounding box so the warp interpolation has valid borders
+        profile: ThresholdProfile with the rules (default: the rules of binary_thresholded()),
+                 it can be swapped between frames with set_profile()
+    """
+    def __init__(self, roi=None, roi_margin=2, profile=None):
+        self.roi = None if roi is None else np.float32(roi)
+        if self.roi is not None and (self.roi.min() < 0 or self.roi.max() > 1):
+            raise ValueError('The ROI is given in fractions of the frame size, got coordinates outside [0, 1]')
+        self.roi_margin = roi_margin
+        self.shape = None
+        self.set_profile(profile or DEFAULT_PROFILE)
+
+    def set_profile(self, profile):
+        # The profile is compiled when it is created, switching e.g. from day to night rules costs nothing per frame
+        self.profile = profile
+
+    def _allocate(self, shape):
+        # Buffers are only reallocated when the frame size changes
+        height, width = shape[:2]
+        self.shape = shape
+        self.binary = np.zeros((height, width), np.uint8)
+        if self.roi is None:
+            self.window = (slice(0, height), slice(0, width))
+        else:
+            # The ROI follows the frame size, like the warp source quad
+            roi = self.roi * np.float32((width, height))
+            x0, y0 = np.floor(roi.min(axis=0)).astype(int) - self.roi_margin
+            x1, y1 = np.ceil(roi.max(axis=0)).astype(int) + self.roi_margin + 1
+            self.window = (slice(max(y0, 0), min(y1, height)), slice(max(x0, 0), min(x1, width)))
+        roi_h = self.window[0].stop - self.window[0].start
+        roi_w = self.window[1].stop - self.window[1].start
+        self.gray = np.empty((roi_h, roi_w), np.uint8)
+        self.sobel = np.empty((roi_h, roi_w), np.int16)
+        self.sobel_scaled = None
+        self.mask = np.empty((roi_h, roi_w), np.uint8)
+        self.combined = np.empty((roi_h, roi_w), np.uint8)
+        # Colour conversions and lookup results of the profile
+        self.buffers = {'gray': self.gray}
+
+    @profile_stage('binary_thresholded')
+    def __call__(self, undist_img, valid_mask=None, out=None, sobel_gain=None):
+        # valid_mask: Optional 0/255 mask of the pixels to keep, e.g. RemapTables.fused_valid
+        # out: Optional caller-provided uint8 array receiving the binary image instead of the internal buffer
+        # sobel_gain: Optional per-row factor of the gradient, e.g. RemapTables.x_magnification for a bird's-eye
+        #             image, so that the gradient is measured in frame pixels as in the threshold-then-warp ordering
+        if self.shape != undist_img.shape:
+            self._allocate(undist_img.shape)
+        img = undist_img[self.window]
+        profile = self.profile
+
+        # Gray image, shared by the gray rules and the gradient
+        cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=self.gray)
+        # Colour rules through the lookup tables of the profile
+        profile.color_mask(img, self.buffers, out=self.combined)
+
+        # Gradient in x direction, exact in int16 for a 3x3 kernel on uint8 input
+        if profile.sobel_ranges and sobel_gain is not None:
+            self._gained_sobel_masks(sobel_gain[self.window[0]], valid_mask)
+        elif profile.sobel_ranges:
+            cv2.Sobel(self.gray, cv2.CV_16S, 1, 0, dst=self.sobel)
+            np.abs(self.sobel, out=self.sobel)
+            max_sobel = int(self.sobel.max())
+            for low, high in profile.sobel_ranges:
+                # low <= uint8(255*|sobel|/max) <= high  <=>  ceil(low*max/255) <= |sobel| < ceil((high+1)*max/255),
+                # compared without rescaling the image
+                if max_sobel == 0:
+                    # A flat image scales to 0 everywhere
+                    self.mask.fill(255 if low <= 0 <= high else 0)
+                elif high >= 255:
+                    cv2.compare(self.sobel, (low*max_sobel + 254) // 255, cv2.CMP_GE, dst=self.mask)
+                else:
+                    cv2.inRange(self.sobel, (low*max_sobel + 254) // 255, ((high+1)*max_sobel + 254) // 255 - 1,
+                                dst=self.mask)
+                cv2.bitwise_or(self.combined, self.mask, dst=self.combined)
+
+        if valid_mask is not None:
+            cv2.bitwise_and(self.combined, valid_mask[self.window], dst=self.combined)
+
+        binary = self.binary
+        if out is not None:
+            binary = out
+            if self.roi is not None:
+                # The pixels outside the ROI are not written below
+                binary.fill(0)
+        # Masks are 0/255, the output is 0/1 like binary_thresholded()
+        cv2.bitwise_and(self.combined, 1, dst=binary[self.window])
+        return binary
+
+    def _gained_sobel_masks(self, gain, valid_mask=None):
+        # A warped image is stretched along x by up to several pixels per frame pixel, which divides its gradient
+        # by the stretch, the gradient is scaled back row by row in float32
+        if self.sobel_scaled is None:
+            self.sobel_scaled = np.empty(self.gray.shape, np.float32)
+        sobel = self.sobel_scaled
+        cv2.Sobel(self.gray, cv2.CV_32F, 1, 0, dst=sobel)
+        np.abs(sobel, out=sobel)
+        np.multiply(sobel, gain[:, None], out=sobel)
+        # The scaling maximum is taken over the valid pixels only, the scaled up frame border would dominate it
+        mask = None if valid_mask is None else valid_mask[self.window]
+        max_sobel = cv2.minMaxLoc(sobel, mask)[1]
+        for low, high in self.profile.sobel_ranges:
+            # low <= uint8(255*|sobel|/max) <= high  <=>  low*max/255 <= |sobel| < (high+1)*max/255
+            if max_sobel == 0:
+                self.mask.fill(255 if low <= 0 <= high else 0)
+            elif high >= 255:
+                cv2.compare(sobel, low*max_sobel/255, cv2.CMP_GE, dst=self.mask)
+            else:
+                upper = np.nextafter(np.float32((high+1)*max_sobel/255), np.float32(0))
+                cv2.inRange(sobel, low*max_sobel/255, float(upper), dst=self.mask)
+            cv2.bitwise_or(self.combined, self.mask, dst=self.combined)
@@ -0,0 +1,123 @@
+from collections import namedtuple
+import numpy as np
+from fitting import meters_per_pixel, REFERENCE_SIZE
+
+
+### Confidence-Gated Lane Tracking ###
+
+# Expected lane width in meters, as measured by the bird's-eye calibration
+LANE_WIDTH = 3.7
+
+# Confidence of a pair of fits, every score is in [0, 1] and the confidence is the lowest of them
+FitConfidence = namedtuple('FitConfidence', ['confidence', 'pixel_score', 'width_score', 'residual_score'])
+
+
+def _residual_rms(x, y, fit):
+    # RMS distance in pixels between the lane pixels and the fit, the fit is evaluated once per row
+    if len(x) == 0:
+        return np.inf
+    rows = np.arange(y.max() + 1)
+    fitx = fit[0]*rows**2 + fit[1]*rows + fit[2]
+    return np.sqrt(np.mean((x - fitx[y])**2))
+
+
+def fit_confidence(shape, left_fit, right_fit, leftx, lefty, rightx, righty, margin, min_pixels=5000,
+                   width_tolerance=1.5):
+    """
+    Scores how much a pair of lane fits can be trusted.
+
+    Parameters:
+        shape: (height, width) of the bird's-eye image
+        left_fit, right_fit: Fits of the frame
+        leftx, lefty, rightx, righty: Lane pixels the fits were made on
+        margin: Half width in pixels of the band the pixels were searched in
+        min_pixels: Pixels per line giving a full pixel score on a 1280x720 image, scaled with the image area
+        width_tolerance: Lane width error in meters giving a width score of 0
+
+    Returns:
+        confidence: FitConfidence with the pixel count, lane width and residual scores
+    """
+    height, width = shape[:2]
+    area_ratio = (height*width) / (REFERENCE_SIZE[0]*REFERENCE_SIZE[1])
+    pixel_score = min(len(leftx), len(rightx)) / (min_pixels*area_ratio)
+
+    # The lane width should stay close to LANE_WIDTH from the bottom to the top of the image
+    xm_per_pix = meters_per_pixel(shape)[1]
+    rows = np.array([0, height//2, height-1])
+    lane_width = xm_per_pix * (np.polyval(right_fit, rows) - np.polyval(left_fit, rows))
+    width_score = 1 - np.abs(lane_width - LANE_WIDTH).max() / width_tolerance
+
+    # Pixels spread evenly over the band (noise, or a flooded threshold) have an RMS residual of margin/sqrt(3),
+    # pixels of a real line are within about a third of it
+    spread = max(_residual_rms(leftx, lefty, left_fit), _residual_rms(rightx, righty, right_fit)) / (margin/np.sqrt(3))
+    residual_score = (1 - spread) / 0.5
+
+    scores = np.clip([pixel_score, width_score, residual_score], 0, 1)
+    return FitConfidence(scores.min(), *scores)
+
+
+class LaneTracker:
+    """
+    Schedules the lane search of a stream from the confidence of its previous fits.
+
+    A confident track is followed in a band around the predicted fits that narrows as the confidence grows,
+    but not below the predicted motion of the lines, the full sliding window search only runs once the
+    confidence stayed low for several frames. Optionally, the search is skipped on every other frame
+    while the track is confident and slow, and the fits are predicted from the history.
+
+    Parameters:
+        high_confidence: Confidence from which the band is the narrowest and frames can be skipped
+        low_confidence: Confidence below which a frame counts as lost, the band is then the full margin
+        max_low_frames: Consecutive low confidence frames that trigger the sliding window search
+        min_margin_ratio: Narrowest band, as a fraction of the full search margin
+        skip_alternate: Skip the search on every other frame while the confidence is high
+        max_skip_motion: Largest predicted motion of the lines allowed on a skipped frame, as a fraction of the full margin
+    """
+    def __init__(self, high_confidence=0.6, low_confidence=0.3, max_low_frames=3, min_margin_ratio=0.4,
+                 skip_alternate=False, max_skip_motion=0.1):
+        self.high_confidence = high_confidence
+        self.low_confidence = low_confidence
+        self.max_low_frames = max_low_frames
+        self.min_margin_ratio = min_margin_ratio
+        self.skip_alternate = skip_alternate
+        self.max_skip_motion = max_skip_motion
+        self.reset()
+
+    def reset(self):
+        self.confidence = None
+        self.low_frames = 0
+        self.skipped = False
+        # Number of frames handled by each kind of search
+        self.counts = {'windows': 0, 'prior': 0, 'skipped': 0}
+
+    def plan(self, has_history, full_margin, motion=0.0):
+        # Search of the next frame: 'windows', 'prior' (band around the predicted fits) or 'skip'
+        # motion: Largest predicted displacement of the lines since the last fit, in pixels
+        if not has_history or self.confidence is None or self.low_frames >= self.max_low_frames:
+            return 'windows'
+        if (self.skip_alternate and not self.skipped and self.confidence >= self.high_confidence
+                and motion <= self.max_skip_motion*full_margin):
+            return 'skip'
+        return 'prior'
+
+    def margin(self, full_margin, motion=0.0):
+        # Band half width around the predicted fits, linear in the confidence between the two thresholds,
+        # and at least the predicted motion as the prediction is only as good as the motion is steady
+        if self.confidence is None:
+            return full_margin
+        t = np.clip((self.confidence - self.low_confidence) / (self.high_confidence - self.low_confidence), 0, 1)
+        margin = max(full_margin * (1 - (1 - self.min_margin_ratio)*t), min(motion, full_margin))
+        return max(1, int(round(margin)))
+
+    def record(self, search, confidence=None):
+        # Updates the state with the search made on a frame and the confidence of its fits
+        self.counts['skipped' if search == 'skip' else search] += 1
+        self.skipped = search == 'skip'
+        if confidence is None:
+            return
+        self.confidence = confidence
+        if confidence < self.low_confidence:
+            # A full search restarts the count, it is only repeated if the low confidence persists
+            self.low_frames = 0 if search == 'windows' else self.low_frames + 1
+        else:
+            self.low_frames = 0
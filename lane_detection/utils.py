@@ -1,7 +1,16 @@
 import numpy as np
 import cv2
-import matplotlib.pyplot as plt
-import os
+import functools
+from collections import namedtuple
+from perspective import (perspective_transforms, load_camera_parameters, scale_camera_matrix, get_remap_tables, remap,
+                         search_size)
+from thresholds import BinaryThresholder
+from fitting import MomentFitter, curvature_radius_meters, meters_per_pixel, scale_fit, has_fit_rows, REFERENCE_SIZE
+from calibration import calibrate
+from lane_pixels import as_lane_pixels
+from overlay import LaneOverlay
+from tracking import fit_confidence
+from profiling import PROFILER, profile_stage
 
 
 
@@ -9,74 +18,29 @@ import os
 ### STEP 1: Camera Calibration ###
 
 def distortion_factors():
-    # Prepare object points
-    # From the provided calibration images, 9*6 corners are identified 
-    nx = 9
-    ny = 6
-    objpoints = []
-    imgpoints = []
-    # Object points are real world points, here a 3D coordinates matrix is generated
-    # z coordinates are 0 and x, y are equidistant as it is known that the chessboard is made of identical squares
-    objp = np.zeros((6*9,3), np.float32)
-    objp[:,:2] = np.mgrid[0:9,0:6].T.reshape(-1,2)
-  
-    # Make a list of calibration images
-    os.listdir("camera_calibration_images/")
-    cal_img_list = os.listdir("camera_calibration_images/")  
-    
-    # Imagepoints are the coresspondant object points with their coordinates in the distorted image
-    # They are found in the image using the Open CV 'findChessboardCorners' function
-    for image_name in cal_img_list:
-        import_from = 'camera_calibration_images/' + image_name
-        img = cv2.imread(import_from)
-        # Convert to grayscale
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        # Find the chessboard corners
-        ret, corners = cv2.findChessboardCorners(gray, (nx, ny), None)
-        # If found, draw corners
-        if ret == True:
-            # Draw and display the corners
-            #cv2.drawChessboardCorners(img, (nx, ny), corners, ret)
-            imgpoints.append(corners)
-            objpoints.append(objp)
-    ret, mtx, dist, rvecs, tvecs = cv2.calibrateCamera(objpoints, imgpoints, gray.shape[::-1], None, None)
-    #undist = cv2.undistort(img, mtx, dist, None, mtx)
-    #export_to = 'camera_cal_undistorted/' + image_name
-    #save the image in the destination folder
-    #plt.imsave(export_to, undist)
-            
+    # From the provided calibration images, 9*6 corners are identified
+    # Corners are detected in parallel and cached per image, see calibration.calibrate()
+    mtx, dist = calibrate('camera_calibration_images/', nx=9, ny=6)[:2]
     return mtx, dist   
 
 
 ### STEP 2: Distortion Correction ###
-def warp(undist_img):
+@profile_stage()
+def warp(undist_img, out=None):
     img_size = (undist_img.shape[1], undist_img.shape[0])
-    offset = 300
-    
-    # Source points taken from images with straight lane lines, these are to become parallel after the warp transform
-    src = np.float32([
-        (190, 720), # bottom-left corner
-        (596, 447), # top-left corner
-        (685, 447), # top-right corner
-        (1125, 720) # bottom-right corner
-    ])
-    # Destination points are to be parallel, taken into account the image size
-    dst = np.float32([
-        [offset, img_size[1]],             # bottom-left corner
-        [offset, 0],                       # top-left corner
-        [img_size[0]-offset, 0],           # top-right corner
-        [img_size[0]-offset, img_size[1]]  # bottom-right corner
-    ])
-    # Calculate the transformation matrix and it's inverse transformation
-    M = cv2.getPerspectiveTransform(src, dst)
-    M_inv = cv2.getPerspectiveTransform(dst, src)
-    warped = cv2.warpPerspective(undist_img, M, img_size)
+    
+    # Source points are taken from images with straight lane lines, destination points are parallel lines
+    # Both are scaled to the frame size, the transformation matrix and it's inverse are computed once per frame size
+    M, M_inv = perspective_transforms(img_size)
+    # The result is written into out when an array is provided by the caller
+    warped = cv2.warpPerspective(undist_img, M, img_size, dst=out)
    
     return warped, M_inv
 
 
 ### STEP 3: Color and Gradient Threshold ###
-def binary_thresholded(undist_img):
+@profile_stage()
+def binary_thresholded(undist_img, out=None):
     # Transform image to gray scale
     gray_img =cv2.cvtColor(undist_img, cv2.COLOR_BGR2GRAY)
     # Apply sobel (derivative) in x direction, this is usefull to detect lines that tend to be vertical
@@ -107,7 +71,8 @@ def binary_thresholded(undist_img):
     # Combine all pixels detected above
     binary_1 = cv2.bitwise_or(sx_binary, white_binary)
     binary_2 = cv2.bitwise_or(hue_binary, sat_binary)
-    binary = cv2.bitwise_or(binary_1, binary_2)
+    # The result is written into out when an array is provided by the caller
+    binary = cv2.bitwise_or(binary_1, binary_2, dst=out)
     #plt.imshow(binary, cmap='gray')
     
     return binary
@@ -116,7 +81,16 @@ def binary_thresholded(undist_img):
 
 ### STEP 4: Detection of Lane Lines Using Histogram ###
 
-def find_lane_pixels_using_histogram(binary_warped):
+def search_parameters(shape, margin=100, minpix=50):
+    # Window margin and minimum pixel count were tuned on 1280x720 bird's-eye images,
+    # the margin follows the image width and the pixel count the window area
+    width_ratio = shape[1] / REFERENCE_SIZE[0]
+    area_ratio = width_ratio * shape[0] / REFERENCE_SIZE[1]
+    return max(1, int(round(margin*width_ratio))), int(round(minpix*area_ratio))
+
+
+@profile_stage()
+def find_lane_pixels_using_histogram(binary_warped, nwindows=9, margin=100, minpix=50):
     # Take a histogram of the bottom half of the image
     histogram = np.sum(binary_warped[binary_warped.shape[0]//2:,:], axis=0)
     
@@ -126,12 +100,9 @@ def find_lane_pixels_using_histogram(binary_warped):
     leftx_base = np.argmax(histogram[:midpoint])
     rightx_base = np.argmax(histogram[midpoint:]) + midpoint
 
-    # Choose the number of sliding windows
-    nwindows = 9
-    # Set the width of the windows +/- margin
-    margin = 100
-    # Set minimum number of pixels found to recenter window
-    minpix = 50
+    # nwindows: the number of sliding windows
+    # margin: the width of the windows +/- margin
+    # minpix: minimum number of pixels found to recenter window
 
     # Set height of windows - based on nwindows above and image shape
     window_height = int(binary_warped.shape[0]//nwindows)
@@ -190,6 +161,65 @@ def find_lane_pixels_using_histogram(binary_warped):
     return leftx, lefty, rightx, righty
 
 
+@profile_stage()
+def find_lane_pixels_using_windows(binary_warped, nwindows=9, margin=None, minpix=None, leftx_base=None, rightx_base=None):
+    """
+    Same sliding window search as find_lane_pixels_using_histogram(), returning identical pixels.
+    
+    The pixels of each window row are a contiguous slice of the row-major LanePixels,
+    so only that slice is tested against the window.
+    
+    Parameters:
+        binary_warped: Warped binary image, or the LanePixels extracted from it
+        nwindows: Number of sliding windows
+        margin: Width of the windows +/- margin (default: search_parameters() of the image)
+        minpix: Minimum number of pixels found to recenter window (default: search_parameters() of the image)
+        leftx_base, rightx_base: Starting points of the windows if already known (e.g. computed for a batch)
+    
+    Returns:
+        leftx, lefty, rightx, righty: Positions of the left and right lane pixels (int16)
+    """
+    pixels = as_lane_pixels(binary_warped)
+    height = pixels.shape[0]
+    default_margin, default_minpix = search_parameters(pixels.shape)
+    margin = default_margin if margin is None else margin
+    minpix = default_minpix if minpix is None else minpix
+    if leftx_base is None or rightx_base is None:
+        # Take a histogram of the bottom half of the image
+        histogram = pixels.histogram(height//2)
+        # Find the peak of the left and right halves of the histogram
+        midpoint = int(histogram.shape[0] // 2)
+        leftx_base = np.argmax(histogram[:midpoint])
+        rightx_base = np.argmax(histogram[midpoint:]) + midpoint
+    leftx_current = int(leftx_base)
+    rightx_current = int(rightx_base)
+
+    window_height = int(height//nwindows)
+    nonzerox, nonzeroy = pixels.x, pixels.y
+
+    left_lane_inds = []
+    right_lane_inds = []
+    # Step through the windows from the bottom of the image to the top
+    for window in range(nwindows):
+        win_y_low = height - (window+1)*window_height
+        rows = pixels.rows(win_y_low, win_y_low + window_height)
+        window_x = nonzerox[rows]
+        good_left_inds = ((window_x >= leftx_current - margin) & (window_x < leftx_current + margin)).nonzero()[0]
+        good_right_inds = ((window_x >= rightx_current - margin) & (window_x < rightx_current + margin)).nonzero()[0]
+        left_lane_inds.append(good_left_inds + rows.start)
+        right_lane_inds.append(good_right_inds + rows.start)
+        # If you found > minpix pixels, recenter next window on their mean position
+        if len(good_left_inds) > minpix:
+            leftx_current = int(np.mean(window_x[good_left_inds]))
+        if len(good_right_inds) > minpix:
+            rightx_current = int(np.mean(window_x[good_right_inds]))
+
+    left_lane_inds = np.concatenate(left_lane_inds)
+    right_lane_inds = np.concatenate(right_lane_inds)
+    return nonzerox[left_lane_inds], nonzeroy[left_lane_inds], nonzerox[right_lane_inds], nonzeroy[right_lane_inds]
+
+
+@profile_stage()
 def fit_poly(binary_warped,leftx, lefty, rightx, righty):
     ### Fit a second order polynomial to each with np.polyfit() ###
     left_fit = np.polyfit(lefty, leftx, 2)
@@ -208,12 +238,21 @@ def fit_poly(binary_warped,leftx, lefty, rightx, righty):
     
     return left_fit, right_fit, left_fitx, right_fitx, ploty
 
+@profile_stage()
+def fit_poly_moments(binary_warped, leftx, lefty, rightx, righty, left_fitter, right_fitter):
+    # The fits are solved from the moment sums kept by the fitters,
+    # the x values of fit_poly() are only computed if a consumer of the LaneGeometry needs them
+    left_fit = left_fitter.update(leftx, lefty)
+    right_fit = right_fitter.update(rightx, righty)
+    return LaneGeometry(binary_warped.shape, left_fit, right_fit)
+
+@profile_stage()
 def draw_poly_lines(binary_warped, left_fitx, right_fitx, ploty):     
     # Create an image to draw on and an image to show the selection window
     out_img = np.dstack((binary_warped, binary_warped, binary_warped))*255
     window_img = np.zeros_like(out_img)
         
-    margin = 100
+    margin = search_parameters(binary_warped.shape)[0]
     # Generate a polygon to illustrate the search window area
     # And recast the x and y points into usable format for cv2.fillPoly()
     left_line_window1 = np.array([np.transpose(np.vstack([left_fitx-margin, ploty]))])
@@ -226,34 +265,35 @@ def draw_poly_lines(binary_warped, left_fitx, right_fitx, ploty):
     right_line_pts = np.hstack((right_line_window1, right_line_window2))
 
     # Draw the lane onto the warped blank image
-    cv2.fillPoly(window_img, int([left_line_pts]), (100, 100, 0))
-    cv2.fillPoly(window_img, int([right_line_pts]), (100, 100, 0))
+    cv2.fillPoly(window_img, np.int32(left_line_pts), (100, 100, 0))
+    cv2.fillPoly(window_img, np.int32(right_line_pts), (100, 100, 0))
     result = cv2.addWeighted(out_img, 1, window_img, 0.3, 0)
     
-    # Plot the polynomial lines onto the image
-    plt.plot(left_fitx, ploty, color='green')
-    plt.plot(right_fitx, ploty, color='blue')
+    # Draw the polynomial lines onto the image
+    cv2.polylines(result, np.int32([np.transpose(np.vstack([left_fitx, ploty]))]), False, (0, 255, 0), 2)
+    cv2.polylines(result, np.int32([np.transpose(np.vstack([right_fitx, ploty]))]), False, (255, 0, 0), 2)
     ## End visualization steps ##
     return result
 
 
-def find_lane_pixels_using_prev_poly(binary_warped):
-    global prev_left_fit
-    global prev_right_fit
+@profile_stage()
+def find_lane_pixels_using_prev_poly(binary_warped, prev_left_fit, prev_right_fit, margin=None):
+    # binary_warped: Warped binary image, or the LanePixels extracted from it
+    pixels = as_lane_pixels(binary_warped)
     # width of the margin around the previous polynomial to search
-    margin = 100
-    # Grab activated pixels
-    nonzero = binary_warped.nonzero()
-    nonzeroy = np.array(nonzero[0])
-    nonzerox = np.array(nonzero[1])    
+    if margin is None:
+        margin = search_parameters(pixels.shape)[0]
+    nonzerox, nonzeroy = pixels.x, pixels.y
     ### Set the area of search based on activated x-values ###
     ### within the +/- margin of our polynomial function ###
-    left_lane_inds = ((nonzerox > (prev_left_fit[0]*(nonzeroy**2) + prev_left_fit[1]*nonzeroy + 
-                    prev_left_fit[2] - margin)) & (nonzerox < (prev_left_fit[0]*(nonzeroy**2) + 
-                    prev_left_fit[1]*nonzeroy + prev_left_fit[2] + margin))).nonzero()[0]
-    right_lane_inds = ((nonzerox > (prev_right_fit[0]*(nonzeroy**2) + prev_right_fit[1]*nonzeroy + 
-                    prev_right_fit[2] - margin)) & (nonzerox < (prev_right_fit[0]*(nonzeroy**2) + 
-                    prev_right_fit[1]*nonzeroy + prev_right_fit[2] + margin))).nonzero()[0]
+    # The polynomials are evaluated once per row and looked up for every pixel of the row
+    ploty = np.arange(pixels.shape[0])
+    prev_left_x = prev_left_fit[0]*(ploty**2) + prev_left_fit[1]*ploty + prev_left_fit[2]
+    prev_right_x = prev_right_fit[0]*(ploty**2) + prev_right_fit[1]*ploty + prev_right_fit[2]
+    left_x = prev_left_x[nonzeroy]
+    right_x = prev_right_x[nonzeroy]
+    left_lane_inds = ((nonzerox > left_x - margin) & (nonzerox < left_x + margin)).nonzero()[0]
+    right_lane_inds = ((nonzerox > right_x - margin) & (nonzerox < right_x + margin)).nonzero()[0]
     # Again, extract left and right line pixel positions
     leftx = nonzerox[left_lane_inds]
     lefty = nonzeroy[left_lane_inds] 
@@ -265,10 +305,10 @@ def find_lane_pixels_using_prev_poly(binary_warped):
 
 ### STEP 6: Calculate Vehicle Position and Curve Radius ###
 
+@profile_stage()
 def measure_curvature_meters(binary_warped, left_fitx, right_fitx, ploty):
-    # Define conversions in x and y from pixels space to meters
-    ym_per_pix = 30/720 # meters per pixel in y dimension
-    xm_per_pix = 3.7/700 # meters per pixel in x dimension
+    # Define conversions in x and y from pixels space to meters, for the size of the bird's-eye image
+    ym_per_pix, xm_per_pix = meters_per_pixel(binary_warped.shape)
     
     left_fit_cr = np.polyfit(ploty*ym_per_pix, left_fitx*xm_per_pix, 2)
     right_fit_cr = np.polyfit(ploty*ym_per_pix, right_fitx*xm_per_pix, 2)
@@ -282,9 +322,18 @@ def measure_curvature_meters(binary_warped, left_fitx, right_fitx, ploty):
     
     return left_curverad, right_curverad
 
+@profile_stage()
+def measure_curvature_meters_from_fit(binary_warped, left_fit, right_fit):
+    # Same radii as measure_curvature_meters(), the meter space fits are derived from the pixel space fits
+    y_eval = binary_warped.shape[0] - 1
+    ym_per_pix, xm_per_pix = meters_per_pixel(binary_warped.shape)
+    return (curvature_radius_meters(left_fit, y_eval, ym_per_pix, xm_per_pix),
+            curvature_radius_meters(right_fit, y_eval, ym_per_pix, xm_per_pix))
+
+@profile_stage()
 def measure_position_meters(binary_warped, left_fit, right_fit):
-    # Define conversion in x from pixels space to meters
-    xm_per_pix = 3.7/700 # meters per pixel in x dimension
+    # Define conversion in x from pixels space to meters, for the size of the bird's-eye image
+    xm_per_pix = meters_per_pixel(binary_warped.shape)[1]
     # Choose the y value corresponding to the bottom of the image
     y_max = binary_warped.shape[0]
     # Calculate left and right line positions at the bottom of the image
@@ -301,24 +350,14 @@ def measure_position_meters(binary_warped, left_fit, right_fit):
 
 ### STEP 7: Project Lane Delimitations Back on Image Plane and Add Text for Lane Info ###
 
-def project_lane_info(img, binary_warped, ploty, left_fitx, right_fitx, M_inv, veh_pos, left_curverad, right_curverad):
-    # Create an image to draw the lines on
-    warp_zero = np.zeros_like(binary_warped).astype(np.uint8)
-    color_warp = np.dstack((warp_zero, warp_zero, warp_zero))
-    
-    # Recast the x and y points into usable format for cv2.fillPoly()
-    pts_left = np.array([np.transpose(np.vstack([left_fitx, ploty]))])
-    pts_right = np.array([np.flipud(np.transpose(np.vstack([right_fitx, ploty])))])
-    pts = np.hstack((pts_left, pts_right))
-    
-    # Draw the lane onto the warped blank image
-    cv2.fillPoly(color_warp, np.array([pts], dtype=np.int32), (0, 255, 0))
-    
-    # Warp the blank back to original image space using inverse perspective matrix (Minv)
-    newwarp = cv2.warpPerspective(color_warp, M_inv, (img.shape[1], img.shape[0]))
-    
-    # Combine the result with the original image
-    out_img = cv2.addWeighted(img, 1, newwarp, 0.3, 0)
+@profile_stage()
+def project_lane_info(img, binary_warped, ploty, left_fitx, right_fitx, M_inv, veh_pos, left_curverad, right_curverad,
+                      overlay=None):
+    # The lane area is projected to the image plane and blended in place, overlay keeps its buffer across frames
+    # The bird's-eye image can be smaller than img (see LanePipeline.search_scale), M_inv then includes the scale
+    if overlay is None:
+        overlay = LaneOverlay()
+    overlay(img, ploty, left_fitx, right_fitx, M_inv, binary_warped.shape[1])
     
     cv2.putText(img,'Curve Radius [m]: '+str((left_curverad+right_curverad)/2)[:7],(40,70), cv2.FONT_HERSHEY_COMPLEX_SMALL, 1.6, (255,255,255),2,cv2.LINE_AA)
     cv2.putText(img,'Center Offset [m]: '+str(veh_pos)[:7],(40,150), cv2.FONT_HERSHEY_COMPLEX_SMALL, 1.6,(255,255,255),2,cv2.LINE_AA)
@@ -328,44 +367,258 @@ def project_lane_info(img, binary_warped, ploty, left_fitx, right_fitx, M_inv, v
 
 ### STEP 8: Lane Finding Pipeline on Video ###
 
-def lane_finding_pipeline(undistored_img, binary_warped, left_fit_hist, right_fit_hist, M_inv):
-    global prev_left_fit
-    global prev_right_fit
-    
-    if (len(left_fit_hist) == 0):
-        leftx, lefty, rightx, righty = find_lane_pixels_using_histogram(binary_warped)
-        left_fit, right_fit, left_fitx, right_fitx, ploty = fit_poly(binary_warped,leftx, lefty, rightx, righty)
-        # Store fit in history
-        left_fit_hist = np.array(left_fit)
-        new_left_fit = np.array(left_fit)
-        left_fit_hist = np.vstack([left_fit_hist, new_left_fit])
-        right_fit_hist = np.array(right_fit)
-        new_right_fit = np.array(right_fit)
-        right_fit_hist = np.vstack([right_fit_hist, new_right_fit])
-    else:
-        prev_left_fit = [np.mean(left_fit_hist[:,0]), np.mean(left_fit_hist[:,1]), np.mean(left_fit_hist[:,2])]
-        prev_right_fit = [np.mean(right_fit_hist[:,0]), np.mean(right_fit_hist[:,1]), np.mean(right_fit_hist[:,2])]
-        leftx, lefty, rightx, righty = find_lane_pixels_using_prev_poly(binary_warped)
-        if (len(lefty) == 0 or len(righty) == 0):
-            leftx, lefty, rightx, righty = find_lane_pixels_using_histogram(binary_warped)
-        left_fit, right_fit, left_fitx, right_fitx, ploty = fit_poly(binary_warped,leftx, lefty, rightx, righty)
+# Lane measurements of one frame, angles in degrees and distances in meters
+# valid is False for a lost frame (too few lane pixels), its fits are then the ones of the history, or NaN
+LaneResult = namedtuple('LaneResult', ['left_fit', 'right_fit', 'left_curverad', 'right_curverad',
+                                       'veh_pos', 'angle_difference', 'angle_centerline_deg', 'center_x', 'valid'])
+
+
+class LaneGeometry:
+    """
+    Lane fits of one frame, with every quantity derived from them computed on first use and then cached.
+
+    The search, the measurements and the overlays of a frame all read the same instance,
+    so the polynomials are evaluated once and the drawn lane always matches the reported numbers.
+
+    Parameters:
+        shape: (height, width) of the bird's-eye image the fits were made on
+        left_fit, right_fit: Second order fits x = f(y) in pixels
+        valid: False if the fits were not found on the frame (see LaneResult)
+    """
+    def __init__(self, shape, left_fit, right_fit, valid=True):
+        self.shape = tuple(shape[:2])
+        self.left_fit = left_fit
+        self.right_fit = right_fit
+        self.valid = valid
+
+    @property
+    def has_fits(self):
+        # A lost frame without history has NaN fits and nothing to draw
+        return bool(np.isfinite(self.left_fit).all() and np.isfinite(self.right_fit).all())
+
+    @functools.cached_property
+    def ploty(self):
+        return np.linspace(0, self.shape[0]-1, self.shape[0])
+
+    @functools.cached_property
+    def left_fitx(self):
+        return self.left_fit[0]*self.ploty**2 + self.left_fit[1]*self.ploty + self.left_fit[2]
+
+    @functools.cached_property
+    def right_fitx(self):
+        return self.right_fit[0]*self.ploty**2 + self.right_fit[1]*self.ploty + self.right_fit[2]
+
+    @functools.cached_property
+    def curvature(self):
+        # (left_curverad, right_curverad) in meters
+        return measure_curvature_meters_from_fit(self, self.left_fit, self.right_fit)
+
+    @functools.cached_property
+    def veh_pos(self):
+        return measure_position_meters(self, self.left_fit, self.right_fit)
+
+    @functools.cached_property
+    def heading(self):
+        # (angle_centerline_deg, angle_difference, center_x)
+        return find_angle_difference(self, self.left_fit, self.right_fit)
+
+    def result(self):
+        # The angle difference is reported from the camera direction to the road centerline
+        angle_centerline_deg, angle_difference, center_x = self.heading
+        return LaneResult(self.left_fit, self.right_fit, self.curvature[0], self.curvature[1], self.veh_pos,
+                          -angle_difference, angle_centerline_deg, center_x, self.valid)
+
+
+def measure_lanes(binary_warped, left_fit, right_fit, valid=True):
+    # Curvature, vehicle position and heading angle of a pair of fits
+    return LaneGeometry(binary_warped.shape, left_fit, right_fit, valid).result()
+
+
+def lane_result_to_frame_scale(lane, binary_warped, img):
+    # Fits and center_x of a downscaled bird's-eye search, expressed in bird's-eye pixels of the frame size
+    x_scale = binary_warped.shape[1] / img.shape[1]
+    y_scale = binary_warped.shape[0] / img.shape[0]
+    if x_scale == 1 and y_scale == 1:
+        return lane
+    return lane._replace(left_fit=scale_fit(lane.left_fit, x_scale, y_scale),
+                         right_fit=scale_fit(lane.right_fit, x_scale, y_scale), center_x=lane.center_x / x_scale)
+
+
+class LanePipeline:
+    """
+    Lane finding state of a single video stream.
+    
+    Each stream owns its own instance, so several camera streams can be processed in one process.
+    
+    Parameters:
+        history_size: Number of previous fits averaged to guide the search on the next frame
+        roi: Optional polygon the thresholding is restricted to, in fractions of the frame size (see BinaryThresholder)
+        warp_first: If True, the colour frame is warped first and thresholded in bird's-eye space,
+                    the roi is then ignored as the warped frame only contains the source quad
+        smoothing: Decay of the moment sums of previous frames in the fits, 0 fits each frame on its own
+        search_scale: Size of the bird's-eye image relative to the frame, e.g. 0.5 thresholds (with warp_first)
+                      and searches a half resolution image, the fits are mapped back to the frame resolution
+        threshold_profile: ThresholdProfile of the camera (default: the rules of binary_thresholded()),
+                           it can be swapped at runtime with thresholder.set_profile()
+        tracker: Optional LaneTracker scheduling the search from the confidence of the fits,
+                 the search is then guided by fits predicted from the latest ones (see predict_fits())
+    """
+    def __init__(self, history_size=10, roi=None, warp_first=False, smoothing=0.0, search_scale=1.0,
+                 threshold_profile=None, tracker=None):
+        self.history_size = history_size
+        self.tracker = tracker
+        self.warp_first = warp_first
+        self.search_scale = search_scale
+        # Threshold stage with buffers reused across the frames of the stream
+        self.thresholder = BinaryThresholder(roi=None if warp_first else roi, profile=threshold_profile)
+        # Lane overlay with its colour buffer reused across the frames of the stream
+        self.overlay = LaneOverlay()
+        # Least-squares fits from pixel moment sums, optionally decayed over previous frames
+        self.left_fitter = MomentFitter(decay=smoothing)
+        self.right_fitter = MomentFitter(decay=smoothing)
+        # Fixed-size ring buffers of the last polynomial fits
+        self.left_fit_hist = np.zeros((history_size, 3))
+        self.right_fit_hist = np.zeros((history_size, 3))
+        self.fit_weights = np.zeros(history_size)
+        self.fit_frames = np.zeros(history_size, np.int64)
+        self.frame_index = 0
+        self.hist_len = 0
+        self.hist_pos = 0
+
+    def reset(self):
+        # Forget the history, the next frame will use the full histogram search
+        self.hist_len = 0
+        self.hist_pos = 0
+        self.left_fitter.reset()
+        self.right_fitter.reset()
+        if self.tracker is not None:
+            self.tracker.reset()
+
+    def add_fit(self, left_fit, right_fit, weight=1.0):
+        # Overwrite the oldest entry once the buffer is full
+        self.left_fit_hist[self.hist_pos] = left_fit
+        self.right_fit_hist[self.hist_pos] = right_fit
+        self.fit_weights[self.hist_pos] = weight
+        self.fit_frames[self.hist_pos] = self.frame_index
+        self.hist_pos = (self.hist_pos + 1) % self.history_size
+        self.hist_len = min(self.hist_len + 1, self.history_size)
+
+    def mean_fits(self):
+        # Average of the fits currently stored in the history
+        prev_left_fit = self.left_fit_hist[:self.hist_len].mean(axis=0)
+        prev_right_fit = self.right_fit_hist[:self.hist_len].mean(axis=0)
+        return prev_left_fit, prev_right_fit
+
+    def predict_fits(self):
+        """
+        Predicts the fits of the current frame from the two latest fits of the history.
+
+        The coefficients are extrapolated at their rate of change per frame, scaled by the confidence
+        of the older fit so that a lost frame does not throw the prediction off. With a single fit
+        in the history, that fit is the prediction.
+        """
+        last = (self.hist_pos - 1) % self.history_size
+        left_fit, right_fit = self.left_fit_hist[last], self.right_fit_hist[last]
+        if self.hist_len < 2:
+            return left_fit.copy(), right_fit.copy()
+        prev = (self.hist_pos - 2) % self.history_size
+        steps = (self.frame_index - self.fit_frames[last]) / max(self.fit_frames[last] - self.fit_frames[prev], 1)
+        rate = steps * min(self.fit_weights[last], self.fit_weights[prev])
+        return (left_fit + rate*(left_fit - self.left_fit_hist[prev]),
+                right_fit + rate*(right_fit - self.right_fit_hist[prev]))
+
+    def predicted_motion(self, left_fit, right_fit, height):
+        # Largest displacement in pixels of the predicted lines from the latest fits, at the top and bottom rows
+        last = (self.hist_pos - 1) % self.history_size
+        rows = np.array([0, height-1])
+        return max(np.abs(np.polyval(left_fit, rows) - np.polyval(self.left_fit_hist[last], rows)).max(),
+                   np.abs(np.polyval(right_fit, rows) - np.polyval(self.right_fit_hist[last], rows)).max())
+
+    def find_lane_fits(self, binary_warped):
+        """
+        Searches the lane pixels of a warped binary frame and fits them to polynomials.
         
-        # Add new values to history
-        new_left_fit = np.array(left_fit)
-        left_fit_hist = np.vstack([left_fit_hist, new_left_fit])
-        new_right_fit = np.array(right_fit)
-        right_fit_hist = np.vstack([right_fit_hist, new_right_fit])
+        The search around the averaged previous fits is used when a history exists,
+        the histogram search is used on the first frame or when it finds no pixels.
+        With a tracker, the band is placed around the predicted fits and narrows with the confidence,
+        the histogram search is used after sustained low confidence, and confident frames may be
+        skipped (see LaneTracker).
+        A frame where a line has pixels on fewer than 3 rows is lost: it is not added to the history
+        and its geometry is flagged invalid (see lost_geometry()).
+        binary_warped can also be the LanePixels of the frame, the image is then not scanned again.
         
-        # Remove old values from history
-        if (len(left_fit_hist) > 10):
-            left_fit_hist = np.delete(left_fit_hist, 0,0)
-            right_fit_hist = np.delete(right_fit_hist, 0,0)
-                                       
-    left_curverad, right_curverad =  measure_curvature_meters(binary_warped, left_fitx, right_fitx, ploty)
-                                     #measure_curvature_meters(binary_warped, left_fitx, right_fitx, ploty)
-    veh_pos = measure_position_meters(binary_warped, left_fit, right_fit) 
-    out_img = project_lane_info(undistored_img, binary_warped, ploty, left_fitx, right_fitx, M_inv, veh_pos, left_curverad, right_curverad)
-    return out_img
+        Returns:
+            geometry: LaneGeometry of the frame
+        """
+        self.frame_index += 1
+        full_margin = search_parameters(binary_warped.shape)[0]
+        search = 'windows' if self.hist_len == 0 else 'prior'
+        if self.tracker is not None and self.hist_len > 0:
+            predicted = self.predict_fits()
+            motion = self.predicted_motion(*predicted, binary_warped.shape[0])
+            search = self.tracker.plan(True, full_margin, motion)
+        elif self.tracker is not None:
+            search = self.tracker.plan(False, full_margin)
+        if search == 'skip':
+            # The fits are predicted from the history, the frame is not searched and not added to the history
+            self.tracker.record(search)
+            return LaneGeometry(binary_warped.shape, *predicted)
+
+        # Both searches read the nonzero pixels extracted once here
+        pixels = as_lane_pixels(binary_warped)
+        margin = full_margin
+        if search == 'prior':
+            if self.tracker is not None:
+                prev_left_fit, prev_right_fit = predicted
+                margin = self.tracker.margin(full_margin, motion)
+            else:
+                prev_left_fit, prev_right_fit = self.mean_fits()
+            leftx, lefty, rightx, righty = find_lane_pixels_using_prev_poly(pixels, prev_left_fit, prev_right_fit, margin)
+            if (len(lefty) == 0 or len(righty) == 0):
+                search = 'windows'
+                margin = full_margin
+        if search == 'windows':
+            leftx, lefty, rightx, righty = find_lane_pixels_using_windows(pixels)
+        if not (has_fit_rows(lefty) and has_fit_rows(righty)):
+            # A line has pixels on fewer than 3 rows, the frame is lost and kept out of the history
+            if self.tracker is not None:
+                self.tracker.record(search, 0.0)
+            return self.lost_geometry(pixels.shape)
+        geometry = fit_poly_moments(pixels, leftx, lefty, rightx, righty, self.left_fitter, self.right_fitter)
+
+        weight = 1.0
+        if self.tracker is not None:
+            weight = fit_confidence(pixels.shape, geometry.left_fit, geometry.right_fit, leftx, lefty, rightx, righty,
+                                    margin).confidence
+            self.tracker.record(search, weight)
+        # Add new values to history
+        self.add_fit(geometry.left_fit, geometry.right_fit, weight)
+        return geometry
+
+    def lost_geometry(self, shape):
+        # Geometry reported for a lost frame: the fits the search was guided by, NaN without history
+        if self.hist_len == 0:
+            return LaneGeometry(shape, np.full(3, np.nan), np.full(3, np.nan), valid=False)
+        fits = self.predict_fits() if self.tracker is not None else self.mean_fits()
+        return LaneGeometry(shape, *fits, valid=False)
+
+    def detect(self, binary_warped):
+        # Lane measurements of the frame without any rendering
+        return self.find_lane_fits(binary_warped).result()
+
+    def process(self, undistored_img, binary_warped, M_inv):
+        geometry = self.find_lane_fits(binary_warped)
+        if not geometry.has_fits:
+            return undistored_img
+        out_img = project_lane_info(undistored_img, binary_warped, geometry.ploty, geometry.left_fitx, geometry.right_fitx,
+                                    M_inv, geometry.veh_pos, *geometry.curvature, overlay=self.overlay)
+        return out_img
+
+
+@profile_stage()
+def lane_finding_pipeline(undistored_img, binary_warped, pipeline, M_inv):
+    # The fit history is carried across frames by the pipeline object of the stream
+    return pipeline.process(undistored_img, binary_warped, M_inv)
 
 
 def calculate_angle_between_lines(line1_slope, line2_slope):
@@ -374,6 +627,7 @@ def calculate_angle_between_lines(line1_slope, line2_slope):
     angle_diff = np.arctan(tan_angle_diff)
     return np.degrees(angle_diff)
 
+@profile_stage()
 def find_angle_difference(binary_warped, left_fit, right_fit):
     y_eval = binary_warped.shape[0] - 1  # Bottom of the image
     
@@ -394,6 +648,7 @@ def find_angle_difference(binary_warped, left_fit, right_fit):
     return angle_centerline_deg, angle_difference, center_x
 
 
+@profile_stage()
 def draw_arrows_with_angle(undistored_img, center_x, angle_centerline_deg, color_centerline=(0, 255, 0), color_camera=(255, 0, 0)):
     """
     Draws arrows representing the camera's looking direction and the centerline direction, with angles.
@@ -434,45 +689,114 @@ def draw_arrows_with_angle(undistored_img, center_x, angle_centerline_deg, color
     return img_with_arrows
 
 
-def process_image(img, left_fit_hist, right_fit_hist):
+def prepare_frame(img, thresholder, warp_first=False, undistorted_out=None, binary_out=None, debug_warp=False,
+                  search_scale=1.0, camera=None):
     """
-    Processes an image to find the lane lines and calculate the angle difference.
+    Stateless part of the pipeline: undistortion, thresholding and warp of one frame.
     
     Parameters:
         img: Input image
-        mtx, dist: Camera matrix and distortion coefficients
+        thresholder: BinaryThresholder used for the frame
+        warp_first: Threshold the warped colour frame instead of warping the thresholded frame
+        undistorted_out, binary_out: Optional caller-provided arrays receiving the undistorted image
+                                     and the warped binary image (e.g. shared memory frame slots)
+        debug_warp: Also warp the colour frame when it is not needed for thresholding
+        search_scale: Size of the bird's-eye images relative to the frame
+        camera: Optional (camera matrix, distortion coefficients), default: load_camera_parameters()
     
     Returns:
-        out_img: Image with lane lines projected
-        angle_difference: The angle difference between the road's centerline and the camera direction
+        undistorted_img: Undistorted image
+        undistorted_warp: Undistorted image in bird's-eye view (None if not computed)
+        binary_warped: Thresholded binary image in bird's-eye view
+        M_inv: Inverse perspective transformation matrix, from the bird's-eye images to the frame
     """
-    # Step 1: Undistort the image
-    mtx, dist = np.load('camera_matrix.npy'), np.load('distortion_coefficients.npy')
-    undistorted_img = cv2.undistort(img, mtx, dist, None, mtx)
-    binary_thresh = binary_thresholded(undistorted_img)
-    
-    # Step 2: Warp the image (bird's-eye view)
-    binary_warped, Minv = warp(binary_thresh)
+    # The undistortion and warp lookup tables are built once per camera, frame size and search scale
+    img_size = (img.shape[1], img.shape[0])
+    mtx, dist = camera if camera is not None else load_camera_parameters()
+    tables = get_remap_tables(scale_camera_matrix(mtx, img_size), dist, img_size, out_size=search_size(img_size, search_scale))
+    with PROFILER.stage('undistort'):
+        undistorted_img = remap(img, tables.undistort, undistorted_out)
+    
+    # The raw frame is undistorted and warped in a single lookup
+    undistorted_warp = None
+    if warp_first or debug_warp:
+        with PROFILER.stage('undistort_warp'):
+            undistorted_warp = remap(img, tables.fused)
+    if warp_first:
+        # Only the warped source quad is thresholded, no second warp is needed,
+        # the gradient is scaled back to frame pixels as the warp stretches the far rows along x
+        binary_warped = thresholder(undistorted_warp, tables.fused_valid, binary_out, tables.x_magnification)
+    else:
+        binary_thresh = thresholder(undistorted_img)
+        with PROFILER.stage('warp'):
+            binary_warped = remap(binary_thresh, tables.warp, binary_out)
+    return undistorted_img, undistorted_warp, binary_warped, tables.M_inv
 
-    undistorted_warp, Minv = warp(undistorted_img)
-    
+
+# Per-frame output of detect_lanes()
+FrameResult = namedtuple('FrameResult', ['lane', 'image', 'debug_views', 'geometry'])
+
+# Overlays that can be requested from detect_lanes(), drawn in this order
+OVERLAYS = ('lane_info', 'arrows')
+
+
+@profile_stage()
+def detect_lanes(img, pipeline, overlays=(), debug=False):
+    """
+    Finds the lane lines of a frame, without any rendering unless overlays or debug views are requested.
     
-    # Step 3: Find lane pixels and fit to polynomials
-    leftx, lefty, rightx, righty = find_lane_pixels_using_histogram(binary_warped)
-    left_fit, right_fit, left_fitx, right_fitx, ploty = fit_poly(binary_warped, leftx, lefty, rightx, righty)
+    Parameters:
+        img: Input image
+        pipeline: LanePipeline holding the fit history of the stream
+        overlays: Overlays drawn on the undistorted image, any of OVERLAYS
+        debug: Also return the bird's-eye debug views
     
-    # Step 4: Calculate the angle difference between the road centerline and the camera direction
-    angle_centerline_deg, angle_difference, center_x = find_angle_difference(binary_warped, left_fit, right_fit)
-    angle_difference *= -1
-    print('Angle difference:', angle_difference)
+    Returns:
+        result: FrameResult with the LaneResult of the frame, the annotated image (None without overlays),
+                a dict of debug views (empty without debug) and the LaneGeometry in search image pixels
+    """
+    undistorted_img, undistorted_warp, binary_warped, M_inv = prepare_frame(img, pipeline.thresholder, pipeline.warp_first,
+                                                                            debug_warp=debug, search_scale=pipeline.search_scale)
+    # The nonzero pixels are extracted once by the search and shared with the fit, the measurements read the geometry
+    geometry = pipeline.find_lane_fits(binary_warped)
+    # Measurements are made in the search image, the fits and positions are reported at the frame resolution
+    lane = lane_result_to_frame_scale(geometry.result(), binary_warped, img)
+
+    # Every overlay reads the same geometry as the reported LaneResult
+    image = None
+    if overlays:
+        image = undistorted_img
+    if overlays and geometry.has_fits:
+        if 'lane_info' in overlays:
+            image = project_lane_info(image, binary_warped, geometry.ploty, geometry.left_fitx, geometry.right_fitx, M_inv,
+                                      lane.veh_pos, lane.left_curverad, lane.right_curverad, pipeline.overlay)
+        if 'arrows' in overlays:
+            image = draw_arrows_with_angle(image, lane.center_x, lane.angle_centerline_deg)
+
+    debug_views = {}
+    if debug:
+        debug_views['undistorted_warp'] = undistorted_warp
+        if geometry.has_fits:
+            debug_views['search_window'] = draw_poly_lines(binary_warped, geometry.left_fitx, geometry.right_fitx, geometry.ploty)
+    return FrameResult(lane, image, debug_views, geometry)
+
+
+@profile_stage()
+def process_image(img, pipeline, show=False):
+    """
+    Processes an image to find the lane lines and calculate the angle difference.
     
-    imgs = lane_finding_pipeline(undistorted_img, binary_warped, left_fit_hist, right_fit_hist, Minv)
-
-    # Step 5: Draw arrows for the camera direction and centerline direction
-    img_with_arrows = draw_arrows_with_angle(imgs, center_x, angle_centerline_deg)
+    Parameters:
+        img: Input image
+        pipeline: LanePipeline holding the fit history of the stream
+        show: Display the bird's-eye view and wait for a key press
     
-
-    cv2.imshow('undistorted_warp', undistorted_warp)
-    cv2.waitKey(0)
-    cv2.destroyAllWindows()
-    return img_with_arrows
\ No newline at end of file
+    Returns:
+        img_with_arrows: Image with lane lines, lane info and direction arrows projected
+    """
+    result = detect_lanes(img, pipeline, overlays=OVERLAYS, debug=show)
+    if show:
+        cv2.imshow('undistorted_warp', result.debug_views['undistorted_warp'])
+        cv2.waitKey(0)
+        cv2.destroyAllWindows()
+    return result.image
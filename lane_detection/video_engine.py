@@ -0,0 +1,131 @@
+import argparse
+import collections
+import multiprocessing
+import time
+import numpy as np
+import cv2
+from utils import LanePipeline, prepare_frame, lane_finding_pipeline
+from thresholds import BinaryThresholder, ThresholdProfile, load_threshold_profiles
+from perspective import load_camera_parameters, search_size
+from frame_ring import FrameRing
+
+
+### Multi-Process Video Processing ###
+
+# State of a pool worker, set once by _init_worker
+_worker = {}
+
+
+def _init_worker(matrix_path, dist_path, roi, warp_first, search_scale, profile_config, ring_spec):
+    # Calibration, threshold buffers and the shared frame ring are set up once per worker process
+    # The threshold profile is sent as its to_dict() config and compiled again in the worker
+    _worker['camera'] = load_camera_parameters(matrix_path, dist_path)
+    profile = None if profile_config is None else ThresholdProfile.from_dict(profile_config)
+    _worker['thresholder'] = BinaryThresholder(roi=None if warp_first else roi, profile=profile)
+    _worker['warp_first'] = warp_first
+    _worker['search_scale'] = search_scale
+    _worker['ring'] = FrameRing.attach(ring_spec)
+
+
+def _prepare_worker_frame(slot):
+    # The frame is read from and the results written to the shared slot, only the slot index and M_inv are pickled
+    ring = _worker['ring']
+    M_inv = prepare_frame(ring.view(slot, 'frame'), _worker['thresholder'], _worker['warp_first'],
+                          ring.view(slot, 'undistorted'), ring.view(slot, 'binary'), search_scale=_worker['search_scale'],
+                          camera=_worker['camera'])[3]
+    return slot, M_inv
+
+
+def read_frames(capture, ring, free_slots):
+    # Decode the video frame by frame (BGR, like cv2.imread) straight into free slots of the ring
+    while free_slots:
+        slot = free_slots.pop()
+        ret, _ = capture.read(ring.view(slot, 'frame'))
+        if not ret:
+            free_slots.append(slot)
+            return
+        yield slot
+
+
+def process_video(input_path, output_path, processes=None, max_pending=None, history_size=10, roi=None,
+                  warp_first=False, search_scale=1.0, matrix_path='camera_matrix.npy', dist_path='distortion_coefficients.npy',
+                  threshold_profile=None):
+    """
+    Processes a video with the stateless stages (undistort, threshold, warp) spread over a process pool.
+
+    Frames move between the processes through a shared memory FrameRing, only slot indices are sent
+    as messages. The lane tracking keeps its history across frames, so it runs in this process on the
+    frames in their original order, and the output frames are written in sequence.
+
+    Parameters:
+        input_path, output_path: Input video and annotated output video
+        processes: Number of worker processes (default: number of CPUs)
+        max_pending: Maximum number of frames in flight, which is also the number of ring slots
+        history_size, roi, warp_first, search_scale: Options of the LanePipeline
+        matrix_path, dist_path: Camera matrix and distortion coefficients used by the workers
+        threshold_profile: ThresholdProfile applied by the workers (default: the rules of binary_thresholded())
+
+    Returns:
+        stats: Number of frames, elapsed seconds and frames per second
+    """
+    processes = processes or multiprocessing.cpu_count()
+    max_pending = max_pending or 4*processes
+    pipeline = LanePipeline(history_size=history_size, roi=roi, warp_first=warp_first, search_scale=search_scale,
+                            threshold_profile=threshold_profile)
+    profile_config = None if threshold_profile is None else threshold_profile.to_dict()
+    capture = cv2.VideoCapture(input_path)
+    fps = capture.get(cv2.CAP_PROP_FPS) or 25
+    size = (int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    binary_size = search_size(size, search_scale)
+    ring = FrameRing(max_pending, {
+        'frame': ((size[1], size[0], 3), np.uint8),
+        'undistorted': ((size[1], size[0], 3), np.uint8),
+        'binary': ((binary_size[1], binary_size[0]), np.uint8),
+    })
+    free_slots = list(range(max_pending))
+    writer = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, size)
+    frames = 0
+    start = time.perf_counter()
+
+    try:
+        with multiprocessing.Pool(processes, _init_worker, (matrix_path, dist_path, roi, warp_first, search_scale,
+                                                           profile_config, ring.spec)) as pool:
+            pending = collections.deque()
+            while True:
+                for slot in read_frames(capture, ring, free_slots):
+                    pending.append(pool.apply_async(_prepare_worker_frame, (slot,)))
+                if not pending:
+                    break
+                # Results are taken in submission order, which reassembles the frame sequence
+                slot, M_inv = pending.popleft().get()
+                out_img = lane_finding_pipeline(ring.view(slot, 'undistorted'), ring.view(slot, 'binary'), pipeline, M_inv)
+                writer.write(out_img)
+                free_slots.append(slot)
+                frames += 1
+    finally:
+        capture.release()
+        writer.release()
+        ring.close()
+    elapsed = time.perf_counter() - start
+    return {'frames': frames, 'seconds': elapsed, 'fps': frames / elapsed if elapsed > 0 else 0.0}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Lane detection on a video file using a process pool')
+    parser.add_argument('input')
+    parser.add_argument('output')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--warp-first', action='store_true')
+    parser.add_argument('--search-scale', type=float, default=1.0)
+    parser.add_argument('--camera-matrix', default='camera_matrix.npy')
+    parser.add_argument('--distortion', default='distortion_coefficients.npy')
+    parser.add_argument('--threshold-profile', default=None, help='Profile name in threshold_profiles.json, e.g. night')
+    parser.add_argument('--profile-camera', default='default', help='Camera of the profile in threshold_profiles.json')
+    args = parser.parse_args()
+    profile = None
+    if args.threshold_profile is not None:
+        profile = load_threshold_profiles()[args.profile_camera][args.threshold_profile]
+    stats = process_video(args.input, args.output, processes=args.processes, warp_first=args.warp_first,
+                          search_scale=args.search_scale, matrix_path=args.camera_matrix, dist_path=args.distortion,
+                          threshold_profile=profile)
+    print('{frames} frames in {seconds:.1f} s ({fps:.1f} frames/s)'.format(**stats))